@@ -0,0 +1,294 @@
+#!/bin/env python3
+
+"""
+Majority Judgment benchmarks on synthetic ballots
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+# Add the parent directories to the Python path, to get majority_judgment.py and the bot polls
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, "discord-bot"))
+
+import numpy as np
+import majority_judgment as mj
+import major_polls as mjp
+import major_outbox
+
+
+# Seeded synthetic ballots as a DataFrame (voters x questions). Each question
+# has its own grade distribution, 'empty_fraction' of the cells are left empty.
+def generate_ballots(voters, questions, grades, values_type="int", empty_fraction=0.0, seed=0):
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    category_names = grade_names(grades, values_type)
+    distributions = rng.dirichlet(np.ones(grades), size=questions)
+    codes = np.stack([rng.choice(grades, size=voters, p=p) for p in distributions], axis=1)
+
+    if values_type == "int":
+        values = (codes + 1).astype(float)
+    else:
+        values = np.array(category_names, dtype=object)[codes]
+    if empty_fraction > 0:
+        values[rng.random(values.shape) < empty_fraction] = np.nan
+
+    columns = ["Q" + str(i + 1) for i in range(questions)]
+    return pd.DataFrame(values, columns=columns), category_names
+
+
+def grade_names(grades, values_type):
+    if values_type == "int":
+        return list(range(1, grades + 1))
+    return ["G" + str(i + 1) for i in range(grades)]
+
+
+# Minimal stand-in for a disnake interaction, only what the click path reads
+class FakeInteraction:
+
+    class Author:
+        def __init__(self, user):
+            self.id = user
+            self.name = "user" + str(user)
+
+    class Component:
+        def __init__(self, custom_id):
+            self.custom_id = custom_id
+
+    def __init__(self, user, custom_id):
+        self.author = self.Author(user)
+        self.component = self.Component(custom_id)
+
+
+# Dispatch a click with major_polls.click as major_bot.major_update does, the
+# replies go through the outbox to a FakeClient instead of Discord
+def dispatch_click(inter, outbox, client):
+    user = inter.author.id
+    reply, poll, _ = mjp.click(inter.component.custom_id, user, inter.author.name)
+    if reply == "validated":
+        outbox.announce(poll.channel_id, lambda names: client.send(", ".join(names)), inter.author.name)
+    elif reply == "complete":
+        content = mjp.complete_message(poll, user)
+        outbox.edit((poll.poll_id, user), lambda: client.edit_original_response(content=content))
+    elif reply == "ballot":
+        content = mjp.next_choice_message(poll, user)
+        buttons = poll.buttons[poll.next_choice(user)]
+        outbox.edit((poll.poll_id, user), lambda: client.edit_original_response(content=content, components=buttons))
+
+
+# Click traffic of every voter: participate, grade every choice, validate
+def bot_clicks(voters, choices, grades, seed=0):
+    rng = np.random.default_rng(seed)
+    poll = mjp.open_poll("Benchmark", ["C" + str(i + 1) for i in range(choices)],
+                         mjp.GRADES[:grades] if grades <= len(mjp.GRADES) else grade_names(grades, "str"),
+                         channel_id="benchmark-" + str(seed))
+    codes = rng.integers(0, len(poll.grades), size=(voters, choices))
+    clicks = []
+    for user in range(voters):
+        clicks.append(FakeInteraction(user, mjp.make_custom_id(poll.poll_id, mjp.ACTION_PARTICIPATE)))
+        for choice_index in range(choices):
+            clicks.append(FakeInteraction(user, mjp.make_custom_id(
+                poll.poll_id, mjp.ACTION_GRADE, choice_index, int(codes[user, choice_index]))))
+        clicks.append(FakeInteraction(user, mjp.make_custom_id(poll.poll_id, mjp.ACTION_VALIDATE)))
+    return poll, clicks
+
+
+# Local stand-in for the Discord API, counts the calls sent by the outbox
+class FakeClient:
+
+    def __init__(self):
+        self.calls = 0
+
+    async def edit_original_response(self, **kwargs):
+        self.calls += 1
+
+    async def send(self, content):
+        self.calls += 1
+
+
+# Every voter grades every choice and validates at once, through the outbox:
+# superseded edits are dropped and the validations are announced together
+def outbox_burst(voters, choices, rate):
+    client = FakeClient()
+    outbox = major_outbox.Outbox(rate=rate)
+
+    async def burst():
+        for choice_index in range(choices):
+            for user in range(voters):
+                outbox.edit(user, lambda choice_index=choice_index: client.edit_original_response(
+                    content="C" + str(choice_index + 1)))
+        for user in range(voters):
+            outbox.announce("benchmark", lambda names: client.send(", ".join(names)), "user" + str(user))
+        await outbox.drain()
+
+    asyncio.run(burst())
+    return voters * (choices + 1), client.calls
+
+
+def timed(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, {"min": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+
+def run_benchmarks(args):
+    import pandas as pd
+
+    df, category_names = generate_ballots(args.voters, args.questions, args.grades,
+                                          args.type, args.empty, args.seed)
+    filler = category_names[len(category_names) // 2]
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, "ballots.csv")
+        df.to_csv(csv_file, index=False)
+
+        _, timings["parse"] = timed(lambda: pd.read_csv(csv_file), args.repeat)
+        results, timings["tally"] = timed(
+            lambda: mj.aggregate_ballots(df, category_names, args.type, filler), args.repeat)
+        _, timings["csv"] = timed(
+            lambda: mj.read_and_aggregate_csv(csv_file, category_names, values_type=args.type,
+                                              empty_value_filler=filler), args.repeat)
+
+    _, timings["rank"] = timed(lambda: mj.majority_ranking(results), args.repeat)
+
+    # Ranking of many candidates, from synthetic tallies
+    rng = np.random.default_rng(args.seed)
+    counts = rng.multinomial(args.voters, np.ones(args.grades) / args.grades, size=args.candidates)
+    candidates = {"C" + str(i): row for i, row in enumerate(counts.tolist())}
+    _, timings["rank_candidates"] = timed(lambda: mj.majority_ranking(candidates), args.repeat)
+    _, timings["robustness"] = timed(lambda: mj.robustness(results, args.samples, args.seed), args.repeat)
+
+    # Ballots spread over 30 days: results at 1000 random times, then hourly majority grades
+    codes, _ = mj.encode_grades(df, category_names, args.type, filler)
+    timeline = mj.BallotTimeline(list(df.columns), category_names)
+    timeline.add(np.sort(rng.uniform(0, 30 * 86400, len(codes))), codes)
+    query_times = rng.uniform(0, 30 * 86400, 1000)
+    _, timings["timeline_queries"] = timed(
+        lambda: [timeline.counts_at(query_time) for query_time in query_times], args.repeat)
+    _, timings["time_series"] = timed(lambda: timeline.time_series(timeline.periods(3600)), args.repeat)
+
+    if not args.no_render:
+        _, timings["render"] = timed(
+            lambda: mj.render_survey(results, category_names, "Benchmark", use_cache=False,
+                                     dpi=args.dpi), args.repeat)
+
+    # Bot: click traffic (with the replies sent through the outbox, without rate
+    # limit, and the poll timeline kept up to date) and display aggregation on
+    # the live counters
+    def clicks():
+        poll, interactions = bot_clicks(args.bot_voters, args.bot_choices, args.grades, args.seed)
+        mjp.poll_timeline(poll)
+        client = FakeClient()
+        outbox = major_outbox.Outbox(rate=1e9)
+
+        async def dispatch_all():
+            for inter in interactions:
+                dispatch_click(inter, outbox, client)
+            await outbox.drain()
+
+        start = time.perf_counter()
+        asyncio.run(dispatch_all())
+        elapsed = time.perf_counter() - start
+        mjp.close_poll(poll)
+        return elapsed, len(interactions), poll
+    (elapsed, clicks_count, poll), _ = timed(clicks, 1)
+    timings["bot_clicks"] = {"min": elapsed, "median": elapsed, "repeat": 1,
+                             "clicks": clicks_count, "per_click": elapsed / clicks_count}
+    _, timings["bot_display"] = timed(poll.results, args.repeat)
+
+    # Outbound API calls of a burst, without rate limit so that only the queue is timed
+    (clicks_count, calls_count), timings["bot_outbox"] = timed(
+        lambda: outbox_burst(args.bot_voters, args.bot_choices, 1e9), 1)
+    timings["bot_outbox"].update({"clicks": clicks_count, "api_calls": calls_count})
+
+    return {
+        "config": {
+            "voters": args.voters,
+            "questions": args.questions,
+            "grades": args.grades,
+            "type": args.type,
+            "empty": args.empty,
+            "seed": args.seed,
+            "candidates": args.candidates,
+            "samples": args.samples,
+            "bot_voters": args.bot_voters,
+            "bot_choices": args.bot_choices,
+            "dpi": args.dpi,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+        },
+        "timings": timings,
+    }
+
+
+# Print the timings, and their ratio to a previous benchmark file
+def print_report(report, previous=None):
+    print("%-16s %12s %12s %10s" % ("stage", "min (s)", "median (s)", "ratio"))
+    for stage, timing in report["timings"].items():
+        ratio = ""
+        if previous is not None and stage in previous["timings"]:
+            ratio = "%.2fx" % (timing["median"] / previous["timings"][stage]["median"])
+        print("%-16s %12.6f %12.6f %10s" % (stage, timing["min"], timing["median"], ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+Benchmark parsing, tallying, ranking, rendering and the bot click path on
+seeded synthetic ballots, and write the timings to a JSON file.
+
+Examples of usages:
+    ./benchmark.py
+    ./benchmark.py -v 200000 -q 40 -T str -e 0.1 -o after.json --compare before.json""",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("-v", "--voters", type=int, default=10000, help="Number of voters. (default: 10000)")
+    parser.add_argument("-q", "--questions", type=int, default=20, help="Number of questions. (default: 20)")
+    parser.add_argument("-g", "--grades", type=int, default=5, help="Size of the grade scale. (default: 5)")
+    parser.add_argument("-T", "--type", default="int", choices=["int", "str"],
+                        help='Type of the grades values. (default: "int")')
+    parser.add_argument("-e", "--empty", type=float, default=0.0,
+                        help="Fraction of empty cells. (default: 0)")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed. (default: 0)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Runs of each stage. (default: 5)")
+    parser.add_argument("--candidates", type=int, default=10000,
+                        help="Number of candidates of the ranking benchmark. (default: 10000)")
+    parser.add_argument("--samples", type=int, default=1000,
+                        help="Resampled tallies of the robustness benchmark. (default: 1000)")
+    parser.add_argument("--bot-voters", type=int, default=1000,
+                        help="Number of voters of the bot benchmark. (default: 1000)")
+    parser.add_argument("--bot-choices", type=int, default=20,
+                        help="Number of choices of the bot benchmark. (default: 20)")
+    parser.add_argument("--dpi", type=int, default=100, help="Resolution of the rendering benchmark. (default: 100)")
+    parser.add_argument("--no-render", action="store_true", default=False, help="Skip the rendering benchmark.")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help='JSON file of the results. (default: "benchmark.json")')
+    parser.add_argument("--compare", help="Previous JSON file to compare with.")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as file:
+            previous = json.load(file)
+    print_report(report, previous)
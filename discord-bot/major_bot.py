@@ -15,37 +15,13 @@ import disnake
 from disnake.ext import commands
 import logging
 import majority_judgment as mj
-import csv
-import uuid
-import re
-
-# One only MJ opened allowed (for now)
-OPENED = False
-
-# Unique ID for any new question
-UUID = uuid.uuid4()
-
-# Keep questions, choices and grades in global scope
-QUESTION = ""
-CHOICES = []
-GRADES = ["Nul", "Bof", "Okay", "Bien", "Top"]
-
-# Results are stored globally as follows:
-#   {{"user" : ["QUESTION[0]" : "value", ...]}}
-RESULTS = {}
-
-# Unfortunately Discord API do not separate buttons per user, so you have to keep
-# in memory any button depending on user, 'custom_id' is defined as follows:
-#   custom_id => str(UUID) + "button_" + GRADES[i] + "_" + str(user) + "_" + choice
-BUTTONS = {}
-
-# Keep the original interaction to edit (ephemeral trick)
-# ORIGINAL_INTER {"user1": inter, "user2": inter...}
-ORIGINAL_INTER = {}
-
-# Validations storage allow a global button deactivation
-# Keep in memory [user1, user2 ...]
-VALIDATIONS = []
+import major_polls as mjp
+import major_store
+import major_metrics
+import major_outbox
+import concurrent.futures
+import io
+import time
 
 # Configure logging with date and time
 logging.basicConfig(
@@ -69,14 +45,95 @@ bot = commands.InteractionBot(test_guilds=test_guilds)
 bot_is_ready = False
 is_first_creation = True
 
+# Opened polls are persisted, and restored at startup
+store = major_store.BallotStore(os.getenv('MAJOR_BOT_DB', 'major_bot.sqlite'))
+store.load()
+store_task = None
+
+# Handlers latency histograms, served on localhost when MAJOR_BOT_METRICS_PORT is set
+metrics_port = os.getenv('MAJOR_BOT_METRICS_PORT', '')
+metrics_server = None
+
+# Ballot message edits and validation announcements go through a rate limited
+# queue: superseded edits of a user are dropped, announcements are grouped
+outbox = major_outbox.Outbox(rate=float(os.getenv('MAJOR_BOT_API_RATE', '20')),
+                             announce_interval=float(os.getenv('MAJOR_BOT_ANNOUNCE_INTERVAL', '5')))
+outbox_task = None
+
+# Charts are rendered out of the event loop, by a bounded pool of threads
+RENDER_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('MAJOR_BOT_RENDER_WORKERS', '2')), thread_name_prefix="render")
+
+# Render jobs in progress, concurrent displays of the same chart share one job:
+#   {cache key: asyncio.Future}
+RENDER_JOBS = {}
+
+def grade_buttons(poll, choice_index):
+    # Buttons are built on demand from the choice's shared custom_ids, the user
+    # is known from the interaction
+    return [
+        disnake.ui.Button(label=label, style=disnake.ButtonStyle.secondary, custom_id=custom_id)
+        for label, custom_id in poll.buttons[choice_index]
+    ]
+
+async def render_poll(poll, results):
+    key = mj.survey_cache_key(results, poll.grades, poll.question, display_major=False)
+
+    # Cache is only used from the event loop
+    images = mj.render_cache_get(key)
+    if images is not None:
+        return images
+
+    job = RENDER_JOBS.get(key)
+    if job is None:
+        job = asyncio.ensure_future(run_render_job(key, results, poll))
+        RENDER_JOBS[key] = job
+        job.add_done_callback(lambda _: RENDER_JOBS.pop(key, None))
+    return await asyncio.shield(job)
+
+async def run_render_job(key, results, poll):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    images = await loop.run_in_executor(
+        RENDER_POOL, lambda: mj.render_survey(results, poll.grades, poll.question,
+                                              display_major=False, use_cache=False))
+    mj.render_cache_put(key, images)
+    logging.info("'%s' rendered in %.3fs (%d page(s))", poll.question, time.perf_counter() - start, len(images))
+    return images
+
+async def edit_ballot_message(poll, inter, user, **kwargs):
+    # The original interaction is lost after a restart, edit the clicked message instead
+    original_inter = poll.original_inter.get(user)
+    if original_inter is not None:
+        # Acknowledge the click now, the edit is queued and only the latest one is sent
+        await inter.response.defer()
+        outbox.edit((poll.poll_id, user), lambda: original_inter.edit_original_response(**kwargs))
+    else:
+        await inter.response.edit_message(**kwargs)
+
+def validation_announcement(names):
+    if len(names) == 1:
+        return "@" + names[0] + " a validé ses choix!"
+    return ", ".join("@" + name for name in names[:-1]) + " et @" + names[-1] + " ont validé leurs choix!"
+
 @bot.event
 async def on_ready():
     global bot_is_ready
+    global store_task
     bot_is_ready = True
+    global metrics_server
+    global outbox_task
+    if store_task is None:
+        store_task = asyncio.create_task(store.run())
+    if outbox_task is None:
+        outbox_task = asyncio.create_task(outbox.run())
+    if metrics_port.isdigit() and metrics_server is None:
+        metrics_server = await major_metrics.start_metrics_server(int(metrics_port))
     print(f"Bot is ready. Logged in as {bot.user}")
 
 # The slash command that responds with a message.
 @bot.slash_command(description="Création d'un jugement majoritaire")
+@major_metrics.timed_handler
 async def major_create(inter: disnake.ApplicationCommandInteraction,
                        question: str = commands.Param(description="Intitulé de la question"),
                        choices: str = commands.Param(description="Choix séparés par un `\";\" (ex : A;B;C)"),
@@ -90,19 +147,14 @@ async def major_create(inter: disnake.ApplicationCommandInteraction,
         return
 
     global is_first_creation
-    global OPENED
-    global QUESTION
-    global CHOICES
-    global UUID
 
-    user = inter.author.id
     user_name = inter.author.name
     logging.info("User %s launched /major_create [%s] [%s]", user_name, question, choices)
 
     if not is_first_creation:
         await inter.response.defer(ephemeral=False)  # Defer the response to avoid timeouts
 
-    if OPENED:
+    if mjp.get_channel_poll(inter.channel_id) is not None:
         await inter.response.send_message(
             "Err: Il y a déjà un jugement majoritaire en cours, lancez `/major_delete` pour l'arrêter.", ephemeral=True)
         return
@@ -113,14 +165,12 @@ async def major_create(inter: disnake.ApplicationCommandInteraction,
         await inter.response.send_message("Err: Tous les choix doivent être différents !\n" + "choices: " + str(_choices), ephemeral=True)
         return
 
-    QUESTION = question
-    CHOICES = _choices
-    UUID = uuid.uuid4()
-    OPENED = True
+    poll = mjp.open_poll(question, _choices, channel_id=inter.channel_id)
 
-    participate_button = disnake.ui.Button(label=QUESTION, style=disnake.ButtonStyle.primary, custom_id=str(UUID) + "participate")
+    participate_button = disnake.ui.Button(label=poll.question, style=disnake.ButtonStyle.primary,
+                      custom_id=mjp.make_custom_id(poll.poll_id, mjp.ACTION_PARTICIPATE))
     reset_button = disnake.ui.Button(label="Recommencer", style=disnake.ButtonStyle.secondary,
-                      custom_id=str(UUID) + "button_reset_" + str(user))
+                      custom_id=mjp.make_custom_id(poll.poll_id, mjp.ACTION_RESET))
 
     if not is_first_creation:
         await inter.followup.send("Un nouveau jugement majoritaire est créé, cliquez sur le bouton ci-dessous pour participer !",
@@ -131,145 +181,54 @@ async def major_create(inter: disnake.ApplicationCommandInteraction,
         is_first_creation = False
 
 @bot.listen("on_button_click")
+@major_metrics.timed_handler
 async def major_update(inter: disnake.MessageInteraction):
-    global QUESTION
-    global CHOICES
-    global RESULTS
-    global VALIDATIONS
-    global ORIGINAL_INTER
-
     user = inter.author.id
     user_name = inter.author.name
 
-    # Validate button, disable any interaction
-    if user in VALIDATIONS:
+    # Dispatch the click in one step from its 'custom_id', the validations are
+    # timed by the click (the majority grades history is built from them)
+    reply, poll, action = mjp.click(inter.component.custom_id, user, user_name, inter.created_at.timestamp())
+    if reply is None:
         return
 
-    # Validation button scope
-    if inter.component.custom_id == str(UUID) + "button_validate_" + str(user):
-
-        # Do not allow Validation if results are not done
-        # could happen if a user click on reset then validate
-        for choice in CHOICES:
-            if RESULTS[user][choice] == None:
-                return
-
-        logging.info("User %s clicked on validate '%s' button", user_name, QUESTION)
-        VALIDATIONS.append(user)
-        await inter.response.send_message("@" + user_name + " a validé ses choix!")
+    if reply == "validated":
+        # Validations are announced together, in a periodic summary message
+        await inter.response.defer()
+        channel = inter.channel
+        outbox.announce(inter.channel_id, lambda names: channel.send(validation_announcement(names)), user_name)
         return
 
-    # Reset button, remove results from user
-    if inter.component.custom_id == str(UUID) + "button_reset_" + str(user):
-        logging.info("User %s clicked on reset '%s' button", user_name, QUESTION)
-        if user not in RESULTS:
-            # The user clicked on reset button but never have make any choice, just ignore
-            return
-        else:
-            del RESULTS[user]
-
-    # Init at participation button click
-    if (inter.component.custom_id == str(UUID) + "participate"
-            or inter.component.custom_id == str(UUID) + "button_reset_" + str(user)):
-        logging.info("User %s asks for '%s' participation", user_name, QUESTION)
-        if user not in RESULTS:
-            logging.info("User %s is participating to '%s'", user_name, QUESTION)
-            RESULTS[user] = {}
-            BUTTONS[user] = {}
-            for choice in CHOICES:
-                RESULTS[user][choice] = None
-                BUTTONS[user][choice] = []
-                for i in range(0, 5):
-                    BUTTONS[user][choice].append(
-                        disnake.ui.Button(label=GRADES[i], style=disnake.ButtonStyle.secondary,
-                            custom_id=str(UUID) + "button_" + GRADES[i] + "_" + str(user) + "_" + choice)
-                    )
-        else:
-            # Ignore if the user click again on participation button
-            return
-
-    # Ignore if the user already have all results
-    results_are_done = True
-    for choice in CHOICES:
-        try:
-            if RESULTS[user][choice] is None:
-                results_are_done = False
-        except KeyError:
-            logging.error("User tried %s an invalid RESULTS[%s][%s] call, maybe he clicked on an old button?", user_name, user, choice)
-            return
-    if results_are_done:
+    if reply == "complete":
+        await edit_ballot_message(poll, inter, user,
+            content=mjp.complete_message(poll, user),
+            components=[disnake.ui.Button(label="Valider", style=disnake.ButtonStyle.success,
+                            custom_id=mjp.make_custom_id(poll.poll_id, mjp.ACTION_VALIDATE)),
+                       disnake.ui.Button(label="Recommencer", style=disnake.ButtonStyle.primary,
+                            custom_id=mjp.make_custom_id(poll.poll_id, mjp.ACTION_RESET))]
+        )
         return
 
-    # Using c_index to be able to access to the next choice
-    for c_index in range(0, len(CHOICES) + 1):
-        choice = CHOICES[c_index]
-        next_choice = choice
-        if RESULTS[user][choice] is None:
-            for i in range(0, 5):
-                if inter.component.custom_id == str(UUID) + "button_" + GRADES[i] + "_" + str(user) + "_" + choice:
-                    RESULTS[user][choice] = GRADES[i]
-                    try:
-                        next_choice = CHOICES[c_index + 1]
-                    except:
-                        logging.info("User %s has finished '%s'", user_name, QUESTION)
-                        await ORIGINAL_INTER[user].edit_original_response(
-                            content="Vous avez répondu à toutes les questions, merci pour votre participation !\n\n Résume de vos choix :\n"
-                            + str(RESULTS[user]) + "\n"
-                            + "\nCommande pour afficher les résultats : **/major_display**\n"
-                            + "\nVoulez-vous valider vos choix ou recommencer le jugement majoritaire ?",
-                            components=[disnake.ui.Button(label="Valider", style=disnake.ButtonStyle.success,
-                                            custom_id=str(UUID) + "button_validate_" + str(user)),
-                                       disnake.ui.Button(label="Recommencer", style=disnake.ButtonStyle.primary,
-                                            custom_id=str(UUID) + "button_reset_" + str(user))]
-                        )
-                        await inter.response.defer()
-                        return
-            break  # do not continue, break loop for the next "choice"
-
     # Display buttons
-    content_msg = "Que pensez-vous de **" + next_choice + "** ?"
-    if ORIGINAL_INTER.get(user) is not None:
-        await ORIGINAL_INTER[user].edit_original_response(content=content_msg, components=BUTTONS[user][next_choice])
-        await inter.response.defer()
+    next_choice = poll.next_choice(user)
+    content_msg = mjp.next_choice_message(poll, user)
+    if poll.original_inter.get(user) is not None or action == mjp.ACTION_GRADE:
+        await edit_ballot_message(poll, inter, user, content=content_msg, components=grade_buttons(poll, next_choice))
     else:
         await inter.response.send_message(
         content_msg,
         ephemeral=True,
-        components=BUTTONS[user][next_choice])
-        ORIGINAL_INTER[user] = inter
-
-def dict_to_csv(data, filename="output.csv"):
-    # Filter out any entries where a sub-dictionary contains None values
-    filtered_data = [v.values() for v in data.values() if None not in v.values()]
-
-    # Check if there is any data left after filtering
-    if not filtered_data:
-        logging.info("No data to write to CSV.")
-        return
-
-    # Write to CSV
-    with open(filename, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-
-        # Assuming all sub-dictionaries have the same keys, use the keys from the first item for the header
-        header = list(data[next(iter(data))].keys())
-        writer.writerow(header)
-
-        # Write the filtered data
-        writer.writerows(filtered_data)
-
-    logging.info(f"CSV file '{filename}' created successfully.")
+        components=grade_buttons(poll, next_choice))
+        poll.original_inter[user] = inter
 
 @bot.slash_command(description="Affichage des résultats du jugement courant")
+@major_metrics.timed_handler
 async def major_display(inter, visibility: str = commands.Param(name="visibilité", description="Affichage privé ou publique", choices=["privé", "publique"])):
 
-    global GRADES
-    global RESULTS
-    global CHOICES
-    global QUESTION
     user_name = inter.author.name
 
-    if not OPENED:
+    poll = mjp.get_channel_poll(inter.channel_id)
+    if poll is None:
         await inter.response.send_message(
             "Aucun jugement majoritaire n'est actuellement ouvert, veuillez utiliser la commande **/major_create**",
             ephemeral=True,
@@ -284,40 +243,70 @@ async def major_display(inter, visibility: str = commands.Param(name="visibilit
 
     await inter.response.defer(ephemeral=ephemeral)  # Defer the response to avoid timeouts
 
-    csv_file = "major_bot.csv"
-    dict_to_csv(RESULTS, csv_file)
-    results = mj.read_and_aggregate_csv(csv_file, category_names=GRADES, ignore_first_column=False, values_type='str')
-    # Remove special chars for Windows files
-    png_file = re.sub(r'\W', '_', QUESTION) + '.png'
-    mj.survey(results, category_names=GRADES, title=QUESTION, plot=False, display_major=False)
-    await inter.send(file=disnake.File(png_file), ephemeral=ephemeral)
-    logging.info("'%s' displayed by user %s", QUESTION, user_name)
+    # Read the live counters, O(choices x grades)
+    results = poll.results()
+    if not any(any(counts) for counts in results.values()):
+        logging.info("No complete ballot to display for '%s'", poll.question)
+        await inter.send("Aucun vote complet pour le moment.", ephemeral=ephemeral)
+        return
+    # Charts are cached, an unchanged poll is not rendered again
+    images = await render_poll(poll, results)
+    files = [
+        disnake.File(io.BytesIO(image), filename=mj.chart_file_name(poll.question, "png", page, len(images)))
+        for page, image in enumerate(images)
+    ]
+    # Discord accepts up to 10 files per message
+    for i in range(0, len(files), 10):
+        await inter.send(files=files[i:i + 10], ephemeral=ephemeral)
+    logging.info("'%s' displayed by user %s", poll.question, user_name)
+
+@bot.slash_command(description="Historique des mentions majoritaires du jugement courant")
+@major_metrics.timed_handler
+async def major_history(inter, interval: str = commands.Param(name="intervalle", description="Durée entre deux lignes de l'historique", choices=["heure", "jour"])):
+
+    user_name = inter.author.name
+
+    poll = mjp.get_channel_poll(inter.channel_id)
+    if poll is None:
+        await inter.response.send_message(
+            "Aucun jugement majoritaire n'est actuellement ouvert, veuillez utiliser la commande **/major_create**",
+            ephemeral=True,
+        )
+        return
+
+    # Majority grades at the end of each hour or day, from the validation times
+    timeline = mjp.poll_timeline(poll)
+    if not len(timeline):
+        await inter.response.send_message("Aucun vote validé pour le moment.", ephemeral=True)
+        return
+    history = io.StringIO()
+    mj.write_time_series_csv(timeline, timeline.periods(3600 if interval == "heure" else 86400), file=history)
+    await inter.response.send_message(
+        file=disnake.File(io.BytesIO(history.getvalue().encode("utf-8")), filename=mj.chart_file_name(poll.question, "csv")),
+        ephemeral=True,
+    )
+    logging.info("'%s' history sent to user %s", poll.question, user_name)
 
 @bot.slash_command(description="Suppression du jugement courant")
+@major_metrics.timed_handler
 async def major_delete(inter: disnake.ApplicationCommandInteraction):
-    global OPENED
-    global QUESTION
-    global CHOICES
-    global RESULTS
-    global BUTTONS
-    global VALIDATIONS
-
     user_name = inter.author.name
-    logging.info("'%s' has been reset by user %s", QUESTION, user_name)
-    OPENED = False
-    prev_question = QUESTION
-    QUESTION = ""
-    CHOICES = []
-    RESULTS = {}
-    BUTTONS = {}
-    VALIDATIONS = []
 
     # defer + asyncio + followup is a workaround do delay Discord 3s timeout
     # fixes "disnake.errors.NotFound: 404 Not Found (error code: 10062): Unknown interaction"
     # fixes "NotFound: 404 Not Found (error code: 10062): Unknown interaction"
     await inter.response.defer(ephemeral=True)  # Defer the response to avoid timeouts
+
+    poll = mjp.get_channel_poll(inter.channel_id)
+    if poll is None:
+        await inter.followup.send("Aucun jugement majoritaire n'est actuellement ouvert dans ce salon.", ephemeral=True)
+        return
+
+    logging.info("'%s' has been reset by user %s", poll.question, user_name)
+    mjp.close_poll(poll)
+
     await asyncio.sleep(1)
-    await inter.followup.send("INFO: Vous avez supprimé le Jugement Majoritaire intitulé : " + prev_question,
+    await inter.followup.send("INFO: Vous avez supprimé le Jugement Majoritaire intitulé : " + poll.question,
                                       ephemeral=True)
 
 # Fetch the bot token from environment variables
@@ -327,5 +316,10 @@ if bot_token is None:
     exit(1)
 else:
     logging.info("MAJOR_BOT_TOKEN=%s", bot_token)
-bot.run(bot_token)
+try:
+    bot.run(bot_token)
+finally:
+    # Stopped (Ctrl+C, docker stop): write the events of the last flush interval
+    store.close()
+    logging.info("Poll events written to %s", store.path)
 
@@ -0,0 +1,119 @@
+#!/bin/env python3
+
+"""
+Majority Judgment Discord bot metrics: latency histograms of the interactions handlers
+"""
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, the last one is +inf
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    # Upper bound of the bucket holding the 'q' quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": {
+                str(bound): count for bound, count in zip(self.buckets + ["+inf"], self.counts)
+            },
+        }
+
+
+# Latency of each handler: {handler name: Histogram}
+HANDLERS = {}
+
+
+def observe(handler, seconds):
+    histogram = HANDLERS.get(handler)
+    if histogram is None:
+        histogram = HANDLERS[handler] = Histogram()
+    histogram.observe(seconds)
+
+
+# Decorator recording the latency of an async handler (signature is kept for disnake)
+def timed_handler(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            observe(function.__name__, time.perf_counter() - start)
+    return wrapper
+
+
+def metrics_json():
+    return json.dumps({handler: histogram.to_dict() for handler, histogram in HANDLERS.items()})
+
+
+def metrics_text():
+    lines = []
+    for handler, histogram in HANDLERS.items():
+        mean = histogram.sum / histogram.count if histogram.count else 0.0
+        lines.append("%s count=%d mean=%.4fs p50<=%gs p99<=%gs max=%.4fs" % (
+            handler, histogram.count, mean, histogram.quantile(0.5), histogram.quantile(0.99), histogram.max))
+        for bound, count in zip(histogram.buckets + ["+inf"], histogram.counts):
+            lines.append("  le=%s %d" % (bound, count))
+    return "\n".join(lines) + "\n"
+
+
+# Local HTTP endpoint: GET /metrics (text) or GET /metrics.json
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Skip the headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if path == "/metrics.json":
+            status, content_type, body = "200 OK", "application/json", metrics_json()
+        elif path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; charset=utf-8", metrics_text()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", "Not found\n"
+        body = body.encode("utf-8")
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                      % (status, content_type, len(body))).encode("latin-1") + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+    server = await asyncio.start_server(handle_metrics_request, host, port)
+    logging.info("Metrics available on http://%s:%d/metrics", host, port)
+    return server
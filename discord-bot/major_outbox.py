@@ -0,0 +1,158 @@
+#!/bin/env python3
+
+"""
+Majority Judgment Discord bot outbound API calls: queued, coalesced and rate limited
+(no Discord dependency, any async callable can be sent)
+"""
+import asyncio
+import collections
+import logging
+import time
+
+
+# Token bucket: at most 'rate' calls per 'per' seconds, in bursts of up to 'rate' calls
+class RateLimiter:
+
+    def __init__(self, rate, per=1.0, clock=time.monotonic):
+        self.rate = rate
+        self.per = per
+        self.clock = clock
+        self.tokens = float(rate)
+        self.updated = clock()
+
+    # Take a token and return 0, or return the seconds to wait for one
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) * self.per / self.rate
+
+
+class Outbox:
+
+    # 'rate', 'per': budget of API calls, 'rate' calls per 'per' seconds
+    # 'announce_interval': seconds between two summaries of the announcements
+    # 'clock', 'sleep': time functions, replaced by the tests and the fake client benchmark
+    def __init__(self, rate=20, per=1.0, announce_interval=5.0, clock=time.monotonic, sleep=asyncio.sleep):
+        self.limiter = RateLimiter(rate, per, clock)
+        self.announce_interval = announce_interval
+        self.sleep = sleep
+        # Calls waiting for a budget, oldest first: {key: coroutine function}.
+        # A newer call of a key replaces the waiting one and keeps its place.
+        self.pending = collections.OrderedDict()
+        # Keys of the calls being sent, a key is never sent twice concurrently
+        # so that an older edit never lands after a newer one
+        self.in_flight = set()
+        # Sending tasks, asyncio only keeps weak references to them
+        self._tasks = set()
+        # Announcements waiting for the next summary: {channel: [send, [name, ...]]}
+        self.announcements = {}
+        self.wakeup = None
+        self.sequence = 0
+        self.stats = {"queued": 0, "coalesced": 0, "sent": 0, "failed": 0, "announced": 0}
+
+    def _notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    # Queue a call replacing any waiting call of the same 'key' (ex: the edit of a user's ballot message)
+    def edit(self, key, call):
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["queued"] += 1
+        self.pending[key] = call
+        self._notify()
+
+    # Queue a call that is never coalesced
+    def call(self, call):
+        self.sequence += 1
+        self.edit(("call", self.sequence), call)
+
+    # Announce 'name' in 'channel' with the next summary, sent as send(names)
+    def announce(self, channel, send, name):
+        announcement = self.announcements.setdefault(channel, [send, []])
+        announcement[1].append(name)
+
+    # Queue one summary call per channel with the waiting announcements
+    def flush_announcements(self):
+        announcements, self.announcements = self.announcements, {}
+        for send, names in announcements.values():
+            self.stats["announced"] += len(names)
+            self.call(lambda send=send, names=names: send(names))
+
+    def _next_key(self):
+        for key in self.pending:
+            if key not in self.in_flight:
+                return key
+        return None
+
+    async def _send(self, key, call):
+        try:
+            await call()
+            self.stats["sent"] += 1
+        except Exception as error:
+            # Rate limited anyway: wait, then retry unless a newer call replaced it
+            retry_after = getattr(error, "retry_after", None)
+            if retry_after is not None:
+                logging.warning("Outbound call rate limited, retrying in %.2fs", retry_after)
+                await self.sleep(retry_after)
+                if key not in self.pending:
+                    self.pending[key] = call
+                    self.pending.move_to_end(key, last=False)
+            else:
+                self.stats["failed"] += 1
+                logging.exception("Outbound call failed")
+        finally:
+            self.in_flight.discard(key)
+            self._notify()
+
+    # Send the waiting calls within the budget, forever
+    async def run_calls(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            key = self._next_key()
+            if key is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = self.limiter.take()
+            if delay > 0:
+                await self.sleep(delay)
+                continue
+            call = self.pending.pop(key)
+            self.in_flight.add(key)
+            task = asyncio.ensure_future(self._send(key, call))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def run_announcements(self):
+        while True:
+            await self.sleep(self.announce_interval)
+            self.flush_announcements()
+
+    async def run(self):
+        await asyncio.gather(self.run_calls(), self.run_announcements())
+
+    # Send everything waiting now (ex: before a shutdown or at the end of a benchmark)
+    async def drain(self):
+        self.flush_announcements()
+        while self.pending or self.in_flight or self._tasks:
+            key = self._next_key()
+            if key is None:
+                # Calls sent by run_calls: wait for their tasks
+                if self._tasks:
+                    await asyncio.wait(list(self._tasks))
+                else:
+                    await asyncio.sleep(0)
+                continue
+            delay = self.limiter.take()
+            if delay > 0:
+                await self.sleep(delay)
+                continue
+            call = self.pending.pop(key)
+            self.in_flight.add(key)
+            await self._send(key, call)
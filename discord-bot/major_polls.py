@@ -0,0 +1,362 @@
+#!/bin/env python3
+
+"""
+Majority Judgment polls state, shared by the Discord bot (no Discord dependency)
+"""
+import array
+import logging
+import time
+import uuid
+
+# Default grades of a poll (ascending order)
+GRADES = ["Nul", "Bof", "Okay", "Bien", "Top"]
+
+# Every button 'custom_id' is parsed in one step, it is defined as follows:
+#   custom_id => "mj:" + poll_id + ":" + action [+ ":" + choice_index + ":" + grade_index]
+CUSTOM_ID_PREFIX = "mj"
+ACTION_PARTICIPATE = "p"
+ACTION_RESET = "r"
+ACTION_VALIDATE = "v"
+ACTION_GRADE = "g"
+
+# Opened polls: {poll_id: Poll}
+POLLS = {}
+
+# Opened poll of each channel: {channel_id: poll_id}
+CHANNEL_POLLS = {}
+
+# Functions called with every poll change, as a JSON serializable event:
+#   ["open", snapshot], ["close", poll_id], [method, poll_id, *arguments]
+LISTENERS = []
+
+
+def emit(event):
+    for listener in LISTENERS:
+        listener(event)
+
+
+def make_custom_id(poll_id, action, choice_index=None, grade_index=None):
+    if action == ACTION_GRADE:
+        return "%s:%s:%s:%d:%d" % (CUSTOM_ID_PREFIX, poll_id, action, choice_index, grade_index)
+    return "%s:%s:%s" % (CUSTOM_ID_PREFIX, poll_id, action)
+
+
+# Return (poll_id, action, choice_index, grade_index) or None for a foreign button
+def parse_custom_id(custom_id):
+    parts = custom_id.split(":")
+    if len(parts) < 3 or parts[0] != CUSTOM_ID_PREFIX:
+        return None
+    if parts[2] == ACTION_GRADE:
+        if len(parts) != 5:
+            return None
+        try:
+            return parts[1], parts[2], int(parts[3]), int(parts[4])
+        except ValueError:
+            return None
+    return parts[1], parts[2], None, None
+
+
+# Grade code of a not graded choice in the ballots storage
+NOT_GRADED = 255
+
+
+class Poll:
+
+    def __init__(self, question, choices, grades=GRADES, channel_id=None, poll_id=None):
+        if len(grades) >= NOT_GRADED:
+            raise Exception("a poll supports up to %d grades" % (NOT_GRADED - 1))
+        self.poll_id = poll_id or uuid.uuid4().hex[:12]
+        self.question = question
+        self.choices = list(choices)
+        self.grades = list(grades)
+        self.channel_id = channel_id
+
+        # Ballots are stored as one byte per (voter, choice), row-major, the
+        # grade index or NOT_GRADED. Rows of reset ballots are reused.
+        self.codes = bytearray()
+        # Row of each participating user: {user: row}
+        self.rows = {}
+        self.free_rows = []
+        # Number of graded choices of each row (choices are graded in order)
+        self.progress = array.array("I")
+        # Live grade counters of the complete ballots:
+        #   [[count of grades[0], count of grades[1], ...] for each choice]
+        self.tallies = [[0] * len(self.grades) for _ in self.choices]
+        # Validated users, their buttons are disabled
+        self.validations = set()
+        # Time of each validation (seconds): {user: time}
+        self.validation_times = {}
+        # Keep the original interaction to edit (ephemeral trick)
+        self.original_inter = {}
+        # Grade buttons (label, custom_id) of each choice, shared by every user
+        self.buttons = [
+            tuple((grade, make_custom_id(self.poll_id, ACTION_GRADE, choice_index, grade_index))
+                  for grade_index, grade in enumerate(self.grades))
+            for choice_index in range(len(self.choices))
+        ]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def is_participating(self, user):
+        return user in self.rows
+
+    def is_complete(self, user):
+        row = self.rows.get(user)
+        return row is not None and self.progress[row] == len(self.choices)
+
+    # Index of the next choice to grade, None if the ballot is complete
+    def next_choice(self, user):
+        progress = self.progress[self.rows[user]]
+        if progress == len(self.choices):
+            return None
+        return progress
+
+    # Grade codes of a ballot, NOT_GRADED for not graded choices
+    def ballot_codes(self, user):
+        start = self.rows[user] * len(self.choices)
+        return self.codes[start:start + len(self.choices)]
+
+    def _new_row(self, user):
+        if self.free_rows:
+            row = self.free_rows.pop()
+            start = row * len(self.choices)
+            self.codes[start:start + len(self.choices)] = bytes([NOT_GRADED]) * len(self.choices)
+            self.progress[row] = 0
+        else:
+            row = len(self.progress)
+            self.codes.extend(bytes([NOT_GRADED]) * len(self.choices))
+            self.progress.append(0)
+        self.rows[user] = row
+        return row
+
+    def start(self, user):
+        if user in self.rows:
+            return False
+        self._new_row(user)
+        emit(["start", self.poll_id, user])
+        return True
+
+    def reset(self, user):
+        if user not in self.rows:
+            return False
+        if self.is_complete(user):
+            self._tally_ballot(self.ballot_codes(user), -1)
+        self.free_rows.append(self.rows.pop(user))
+        emit(["reset", self.poll_id, user])
+        return True
+
+    # Grade the next choice of a ballot, ignore old or foreign buttons
+    def grade(self, user, choice_index, grade_index):
+        row = self.rows.get(user)
+        if row is None or self.progress[row] != choice_index or not 0 <= grade_index < len(self.grades):
+            return False
+        self.codes[row * len(self.choices) + choice_index] = grade_index
+        self.progress[row] += 1
+        if self.progress[row] == len(self.choices):
+            self._tally_ballot(self.ballot_codes(user), 1)
+        emit(["grade", self.poll_id, user, choice_index, grade_index])
+        return True
+
+    # 'at': time of the validation (seconds), now by default
+    def validate(self, user, at=None):
+        if user in self.validations or not self.is_complete(user):
+            return False
+        at = time.time() if at is None else at
+        self.validations.add(user)
+        self.validation_times[user] = at
+        emit(["validate", self.poll_id, user, at])
+        return True
+
+    # Validated ballots in validation order, as (times, grade codes) where the
+    # codes of not graded choices are -1 (see majority_judgment.BallotTimeline)
+    def validated_ballots(self):
+        users = sorted(self.validation_times, key=self.validation_times.get)
+        return ([self.validation_times[user] for user in users],
+                [[-1 if grade == NOT_GRADED else grade for grade in self.ballot_codes(user)] for user in users])
+
+    # Ballot of a user as {"choice": "grade"}, None for not graded choices
+    def ballot_summary(self, user):
+        return {
+            choice: None if grade == NOT_GRADED else self.grades[grade]
+            for choice, grade in zip(self.choices, self.ballot_codes(user))
+        }
+
+    # Aggregated results, as returned by majority_judgment.read_and_aggregate_csv
+    def results(self):
+        return {choice: list(counts) for choice, counts in zip(self.choices, self.tallies)}
+
+    # JSON serializable state, the interactions are not kept
+    def snapshot(self):
+        return {
+            "poll_id": self.poll_id,
+            "question": self.question,
+            "choices": self.choices,
+            "grades": self.grades,
+            "channel_id": self.channel_id,
+            "ballots": [
+                [user, [None if grade == NOT_GRADED else grade for grade in self.ballot_codes(user)]]
+                for user in self.rows
+            ],
+            "validations": list(self.validations),
+            "validation_times": [[user, at] for user, at in self.validation_times.items()],
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        poll = cls(snapshot["question"], snapshot["choices"], snapshot["grades"],
+                   snapshot["channel_id"], snapshot["poll_id"])
+        for user, ballot in snapshot["ballots"]:
+            row = poll._new_row(user)
+            start = row * len(poll.choices)
+            poll.codes[start:start + len(poll.choices)] = bytes(
+                NOT_GRADED if grade is None else grade for grade in ballot)
+            poll.progress[row] = len(ballot) - ballot.count(None)
+            if poll.is_complete(user):
+                poll._tally_ballot(poll.ballot_codes(user), 1)
+        poll.validations = set(snapshot["validations"])
+        poll.validation_times = {user: at for user, at in snapshot.get("validation_times", [])}
+        return poll
+
+    def _tally_ballot(self, ballot, delta):
+        # Add (delta=1) or remove (delta=-1) a complete ballot from the live counters
+        for counts, grade in zip(self.tallies, ballot):
+            counts[grade] += delta
+
+
+def register_poll(poll):
+    POLLS[poll.poll_id] = poll
+    CHANNEL_POLLS[poll.channel_id] = poll.poll_id
+    return poll
+
+
+def open_poll(question, choices, grades=GRADES, channel_id=None):
+    poll = register_poll(Poll(question, choices, grades, channel_id))
+    emit(["open", poll.snapshot()])
+    return poll
+
+
+def get_channel_poll(channel_id):
+    poll_id = CHANNEL_POLLS.get(channel_id)
+    if poll_id is None:
+        return None
+    return POLLS.get(poll_id)
+
+
+def close_poll(poll):
+    POLLS.pop(poll.poll_id, None)
+    if CHANNEL_POLLS.get(poll.channel_id) == poll.poll_id:
+        del CHANNEL_POLLS[poll.channel_id]
+    emit(["close", poll.poll_id])
+
+
+# Apply a button click of 'user' to its poll, returns (reply, poll, action)
+# where 'reply' is what the voter is shown next, None for an ignored click:
+#   "validated": the validation is announced
+#   "complete": the ballot summary, with the validate and reset buttons
+#   "ballot": the grade buttons of the next choice
+# 'at' is the time of the click (seconds), the time of a validation.
+def click(custom_id, user, user_name=None, at=None):
+    user_name = user_name or str(user)
+    parsed = parse_custom_id(custom_id)
+    if parsed is None:
+        return None, None, None
+    poll_id, action, choice_index, grade_index = parsed
+    poll = POLLS.get(poll_id)
+    if poll is None:
+        logging.info("User %s clicked on a button of a closed poll", user_name)
+        return None, None, action
+
+    # Validate button, disable any interaction
+    if user in poll.validations:
+        return None, poll, action
+
+    if action == ACTION_VALIDATE:
+        # Do not allow Validation if results are not done
+        # could happen if a user click on reset then validate
+        if not poll.validate(user, at):
+            return None, poll, action
+        logging.info("User %s clicked on validate '%s' button", user_name, poll.question)
+        return "validated", poll, action
+
+    # Reset button, remove results from user
+    if action == ACTION_RESET:
+        logging.info("User %s clicked on reset '%s' button", user_name, poll.question)
+        if not poll.reset(user):
+            # The user clicked on reset button but never have make any choice, just ignore
+            return None, poll, action
+
+    # Init at participation button click
+    if action in (ACTION_PARTICIPATE, ACTION_RESET):
+        logging.info("User %s asks for '%s' participation", user_name, poll.question)
+        if not poll.start(user):
+            # Ignore if the user click again on participation button
+            return None, poll, action
+        logging.info("User %s is participating to '%s'", user_name, poll.question)
+        return "ballot", poll, action
+
+    if action == ACTION_GRADE:
+        if not poll.grade(user, choice_index, grade_index):
+            logging.error("User %s clicked on an invalid grade button, maybe he clicked on an old button?", user_name)
+            return None, poll, action
+        if poll.is_complete(user):
+            logging.info("User %s has finished '%s'", user_name, poll.question)
+            return "complete", poll, action
+        return "ballot", poll, action
+
+    return None, poll, action
+
+
+# Messages shown to a voter, for the "ballot" and "complete" replies of click()
+def next_choice_message(poll, user):
+    return "Que pensez-vous de **" + poll.choices[poll.next_choice(user)] + "** ?"
+
+
+def complete_message(poll, user):
+    return ("Vous avez répondu à toutes les questions, merci pour votre participation !\n\n Résume de vos choix :\n"
+            + str(poll.ballot_summary(user)) + "\n"
+            + "\nCommande pour afficher les résultats : **/major_display**\n"
+            + "\nVoulez-vous valider vos choix ou recommencer le jugement majoritaire ?")
+
+
+# Timelines of the validated ballots, built at the first call of a poll, then
+# kept up to date with its validations: {poll_id: majority_judgment.BallotTimeline}
+TIMELINES = {}
+
+
+def poll_timeline(poll):
+    timeline = TIMELINES.get(poll.poll_id)
+    if timeline is None:
+        import majority_judgment as mj
+
+        timeline = mj.BallotTimeline(poll.choices, poll.grades)
+        timeline.add(*poll.validated_ballots())
+        TIMELINES[poll.poll_id] = timeline
+    return timeline
+
+
+def update_timeline(event):
+    if event[0] == "close":
+        TIMELINES.pop(event[1], None)
+    elif event[0] == "validate" and event[1] in TIMELINES:
+        _, poll_id, user, at = event
+        codes = POLLS[poll_id].ballot_codes(user)
+        TIMELINES[poll_id].add([at], [[-1 if grade == NOT_GRADED else grade for grade in codes]])
+
+
+LISTENERS.append(update_timeline)
+
+
+# Replay an event emitted by a poll (see LISTENERS)
+def apply_event(event):
+    kind = event[0]
+    if kind == "open":
+        register_poll(Poll.from_snapshot(event[1]))
+        return
+    poll = POLLS.get(event[1])
+    if poll is None:
+        return
+    if kind == "close":
+        close_poll(poll)
+    else:
+        getattr(poll, kind)(*event[2:])
@@ -0,0 +1,150 @@
+#!/bin/env python3
+
+"""
+Majority Judgment polls persistence (SQLite), opened polls survive a restart
+"""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sqlite3
+
+import major_polls as mjp
+
+# Events are appended to a log, and every opened poll is regularly saved as a
+# snapshot. At startup, each poll is rebuilt from its last snapshot plus the
+# events that follow it (the log tail), older events are deleted.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY,
+    poll_id TEXT NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_poll_id ON events (poll_id, seq);
+CREATE TABLE IF NOT EXISTS snapshots (
+    poll_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    snapshot TEXT NOT NULL
+);
+"""
+
+
+class BallotStore:
+
+    # 'flush_interval': seconds between two batched writes
+    # 'snapshot_every': minimum number of events of a poll between two snapshots,
+    #                   raised to the number of ballots so that snapshots stay amortized
+    def __init__(self, path, flush_interval=0.5, snapshot_every=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.pending = []
+        self.events_since_snapshot = {}
+        # SQLite is only used from this thread, out of the event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    # Rebuild the opened polls, to be called before any poll is created
+    def load(self):
+        connection = self.executor.submit(self._connect).result()
+        rows = self.executor.submit(self._read, connection).result()
+        snapshots, events = rows
+
+        for seq, snapshot in snapshots:
+            mjp.register_poll(mjp.Poll.from_snapshot(json.loads(snapshot)))
+            self.seq = max(self.seq, seq)
+        for seq, event in events:
+            mjp.apply_event(json.loads(event))
+            self.seq = max(self.seq, seq)
+
+        logging.info("%d poll(s) restored from %s (%d snapshot(s), %d event(s) replayed)",
+                     len(mjp.POLLS), self.path, len(snapshots), len(events))
+        mjp.LISTENERS.append(self.record)
+
+    def _read(self, connection):
+        snapshots = connection.execute("SELECT seq, snapshot FROM snapshots").fetchall()
+        events = connection.execute(
+            "SELECT e.seq, e.event FROM events e LEFT JOIN snapshots s ON e.poll_id = s.poll_id "
+            "WHERE s.seq IS NULL OR e.seq > s.seq ORDER BY e.seq"
+        ).fetchall()
+        return snapshots, events
+
+    # Listener of the polls events, never blocks: events are written by run()
+    def record(self, event):
+        if event[0] == "open":
+            poll_id = event[1]["poll_id"]
+        else:
+            poll_id = event[1]
+
+        if event[0] == "close":
+            self.events_since_snapshot.pop(poll_id, None)
+            self.pending.append(("close", poll_id))
+            return
+
+        self.seq += 1
+        self.pending.append(("event", self.seq, poll_id, json.dumps(event)))
+
+        count = self.events_since_snapshot.get(poll_id, 0) + 1
+        poll = mjp.POLLS.get(poll_id)
+        if poll is not None and count >= max(self.snapshot_every, len(poll)):
+            self.pending.append(("snapshot", self.seq, poll_id, json.dumps(poll.snapshot())))
+            count = 0
+        self.events_since_snapshot[poll_id] = count
+
+    # Write the pending events every 'flush_interval' seconds
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(loop)
+
+    async def flush(self, loop=None):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        loop = loop or asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._write, batch)
+        except sqlite3.Error:
+            logging.exception("Failed to write %d poll event(s) to %s", len(batch), self.path)
+            self.pending = batch + self.pending
+
+    # Write the pending events and close the database, once the event loop is
+    # stopped (the last batch would be lost on a shutdown otherwise)
+    def close(self):
+        batch, self.pending = self.pending, []
+        try:
+            if batch:
+                self.executor.submit(self._write, batch).result()
+        except sqlite3.Error:
+            logging.exception("Failed to write %d poll event(s) to %s", len(batch), self.path)
+        finally:
+            self.executor.submit(self._close).result()
+            self.executor.shutdown()
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _write(self, batch):
+        connection = self._connect()
+        with connection:
+            for item in batch:
+                if item[0] == "event":
+                    connection.execute("INSERT INTO events (seq, poll_id, event) VALUES (?, ?, ?)", item[1:])
+                elif item[0] == "snapshot":
+                    _, seq, poll_id, snapshot = item
+                    connection.execute("INSERT OR REPLACE INTO snapshots (poll_id, seq, snapshot) VALUES (?, ?, ?)",
+                                       (poll_id, seq, snapshot))
+                    connection.execute("DELETE FROM events WHERE poll_id = ? AND seq <= ?", (poll_id, seq))
+                else:
+                    connection.execute("DELETE FROM events WHERE poll_id = ?", (item[1],))
+                    connection.execute("DELETE FROM snapshots WHERE poll_id = ?", (item[1],))
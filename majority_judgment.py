@@ -4,124 +4,1371 @@
 Majority Judgment Bar Chart Distribution from CSV Data
 """
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import numpy as np
-import pandas as pd
 import argparse
 from argparse import RawTextHelpFormatter
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import glob
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import os
 import re
+import sys
+import time
+import tracemalloc
 
+# pandas (CSV parsing) and matplotlib (charts) are slow to import, they are
+# imported by the functions needing them, so that computing tallies and rankings
+# never loads matplotlib.
 
-# Supported values_type : 'int' or 'str'
 
-def read_and_aggregate_csv(file_path, category_names,ignore_first_column=False, values_type="int", empty_value_filler=3):
+# Maximum number of invalid cells reported by the validation summary
+MAX_REPORTED_CELLS = 10
 
-    df = pd.read_csv(file_path)
-    # Deleting the first column of the csv if -I has been called
-    if ignore_first_column == True:
-        first_column = df.columns[0]
-        df = df.drop([first_column], axis=1)
-    max_count = len(category_names)
+# Rendered charts cache of the process: {key: (image bytes of each page, ...)},
+# least recently used first. The CLI runs also share an on-disk cache (see render_survey).
+RENDER_CACHE = collections.OrderedDict()
+RENDER_CACHE_BYTES = 0
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
 
+# Charts with more questions are split into several pages
+ROWS_PER_PAGE = 40
 
-    if values_type == "int":
-        #function to check if there are empty values and fill those values with desired 'filler
-        df = df.fillna(empty_value_filler).astype(int)
-
-        #function to check if values are within desired range
-        for index,row in df.iterrows():
-            for num in row.values:
-                if not 1<=num<=max_count:
-                    print('number outside of range')
-                    print(num)
-                else:
-                    continue
 
-        aggregated_results = {}
-        for question in df.columns:
-            # Adjust to map category names to their indices
-            mapped_df = df[question].replace(
-                {name: i + 1 for i, name in enumerate(category_names)}
-            )
-            counts = df[question].value_counts().sort_index()
-            for rating in range(1, max_count + 1):
-                if rating not in counts:
-                    counts[rating] = 0
-            aggregated_results[question] = counts.sort_index().tolist()
-        return aggregated_results
+# Functions called at the end of every profiled stage, as:
+#   hook(stage, seconds, peak_memory_bytes)
+# The stages are "read", "encode", "tally" and "validate" for the aggregation,
+# "draw", "save" and "write" for the charts.
+PROFILE_HOOKS = []
 
 
-    elif values_type == "str":
-        #fucntion to check if there are empty values, and fill those values with desired 'filler'
-        df = df.fillna(empty_value_filler).astype(str)
-        print(df)
+# Time a stage and trace its peak memory, only when a hook is registered
+@contextlib.contextmanager
+def profile_stage(stage):
+    if not PROFILE_HOOKS:
+        yield
+        return
+    tracemalloc.reset_peak()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_memory = max(tracemalloc.get_traced_memory()[1] - memory_start, 0)
+        for hook in PROFILE_HOOKS:
+            hook(stage, seconds, peak_memory)
+
+
+# Stages statistics, to be registered with enable_profiling()
+class StageProfile:
+
+    def __init__(self):
+        # {stage: {"calls": int, "seconds": float, "peak_memory": int}}
+        self.stages = {}
+
+    def __call__(self, stage, seconds, peak_memory):
+        stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "peak_memory": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["peak_memory"] = max(stats["peak_memory"], peak_memory)
+
+    def report(self):
+        lines = ["%-10s %6s %12s %14s" % ("stage", "calls", "time (s)", "peak mem (MiB)")]
+        for stage, stats in self.stages.items():
+            lines.append("%-10s %6d %12.6f %14.2f" % (
+                stage, stats["calls"], stats["seconds"], stats["peak_memory"] / 2 ** 20))
+        return "\n".join(lines)
+
 
-        # Convert category names to a set for efficient lookup
-        category_names_set = set(category_names)
+# Register a profiling hook, memory tracing slows down the profiled code
+def enable_profiling(hook):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    PROFILE_HOOKS.append(hook)
 
 
-        # Function to check if a value is out of the desired categories
-        mask = df.isin(category_names_set)
-        rows_with_false = mask[~mask.all(axis=1)]
-        column_with_false = rows_with_false.columns[(~rows_with_false).any()]
+def disable_profiling(hook):
+    PROFILE_HOOKS.remove(hook)
+    if not PROFILE_HOOKS:
+        tracemalloc.stop()
 
-        mask1 = mask.all().all()
-        if not mask1.all():
-            print('Values not in desired categories')
-            print(rows_with_false[column_with_false])
 
+# Encode a ballot DataFrame (or a 2-D integer array of grades) into a
+# (voters x questions) matrix of grade codes.
+# Codes are 0-based indexes in the category order, invalid cells get -1.
+# Supported values_type : 'int' or 'str'
+def encode_grades(df, category_names, values_type="int", empty_value_filler=3):
+    max_count = len(category_names)
+
+    if values_type == "int":
+        if isinstance(df, np.ndarray) and np.issubdtype(df.dtype, np.integer):
+            # Nothing to fill nor convert, use the array as is
+            values = df
+        else:
+            # Fill empty values with the desired 'filler'
+            values = df.fillna(empty_value_filler).astype(int).to_numpy()
+        # Signed codes, unsigned grade arrays (ex: uint8) would wrap around
+        codes = values.astype(np.int64) - 1
+        codes[(codes < 0) | (codes >= max_count)] = -1
+
+    elif values_type == "str":
+        import pandas as pd
+
+        if isinstance(df, pd.DataFrame) and len(df.columns) and (df.dtypes == "category").all():
+            # Categorical columns (see iter_ballot_chunks): only their few distinct
+            # values are looked up, empty cells (code -1) get the filler's code
+            lookup = {str(name): code for code, name in enumerate(category_names)}
+            filler_code = lookup.get(str(empty_value_filler), -1)
+            codes = np.empty(df.shape, dtype=np.int64)
+            for i, column in enumerate(df.columns):
+                categorical = df[column].array
+                mapping = np.array([lookup.get(str(c), -1) for c in categorical.categories] + [filler_code])
+                codes[:, i] = mapping[categorical.codes]
+            # Only read to report the invalid cells
+            values = df
         else:
-            aggregated_results = {}
-            for question in df.columns:
-                # Adjust to map category names to their indices
-                mapped_df = df[question].replace(
-                    {name: i + 1 for i, name in enumerate(category_names)}
-                )
-                counts = df[question].value_counts().sort_index()
-                for cat in category_names_set:
-                    if cat not in counts:
-                        counts[cat] = 0
-                aggregated_results[question] = counts.sort_index().tolist()
-        return aggregated_results
+            # Fill empty values with the desired 'filler'
+            values = df.fillna(empty_value_filler).astype(str).to_numpy()
+            # Text grades are coded in the categories order
+            categories = [str(name) for name in category_names]
+            codes = pd.Categorical(values.ravel(), categories=categories).codes
+            codes = codes.reshape(values.shape).astype(np.int64)
 
     else:
         raise Exception(
             "values_type='" + values_type + "' is not supported, try 'int' or 'str'"
         )
 
+    return codes, values
+
+
+# Return a bounded summary of the invalid cells of a grade codes matrix:
+#   {"count": 2, "cells": [{"row": 3, "question": "Q1", "value": 7}, ...]}
+def check_grade_codes(codes, values, questions, max_cells=MAX_REPORTED_CELLS):
+    rows, columns = np.nonzero(codes < 0)
+    bad_rows, bad_columns = rows[:max_cells], columns[:max_cells]
+    if hasattr(values, "iat"):
+        bad_values = [values.iat[r, c] for r, c in zip(bad_rows.tolist(), bad_columns.tolist())]
+    else:
+        bad_values = values[bad_rows, bad_columns].tolist()
+    cells = [
+        {"row": int(r), "question": questions[c], "value": v}
+        for r, c, v in zip(bad_rows, bad_columns, bad_values)
+    ]
+    return {"count": len(rows), "cells": cells}
+
+
+# Count every question in one pass, returns a (questions x grades) matrix.
+# Invalid codes (-1) are ignored.
+def tally_grade_codes(codes, grades_count):
+    questions_count = codes.shape[1]
+    valid = codes >= 0
+    flat = (codes + np.arange(questions_count) * grades_count)[valid]
+    counts = np.bincount(flat, minlength=questions_count * grades_count)
+    return counts.reshape(questions_count, grades_count)
+
+
+# On stderr, so that the -o outputs on stdout stay parseable
+def print_invalid_summary(summary):
+    if summary["count"] == 0:
+        return
+    print("%d value(s) not in desired categories, ignored:" % summary["count"], file=sys.stderr)
+    for cell in summary["cells"]:
+        print("  row %(row)d, %(question)s: %(value)r" % cell, file=sys.stderr)
+    if summary["count"] > len(summary["cells"]):
+        print("  ...", file=sys.stderr)
+
+
+# Fastest read_csv engine available, pyarrow does not stream chunks
+def csv_engine(chunksize=None):
+    if chunksize is None and importlib.util.find_spec("pyarrow") is not None:
+        return "pyarrow"
+    return "c"
+
+
+# Read the ballots of a CSV file, as a whole or by chunks of 'chunksize' rows.
+# Only the grade columns are parsed (the first one with -I, and the
+# 'ignore_columns', are skipped at parse time), as small floats for 'int' grades
+# or as categoricals for 'str' ones.
+# The 'label_columns' (segments, times) are also read, as categoricals.
+def iter_ballot_chunks(file_path, ignore_first_column=False, chunksize=None, values_type=None,
+                       label_columns=(), ignore_columns=()):
+    import pandas as pd
+
+    options = {"engine": csv_engine(chunksize)}
+    if ignore_first_column == True or label_columns or ignore_columns:
+        columns = list(pd.read_csv(file_path, nrows=0).columns)
+        if hasattr(file_path, "seek"):
+            file_path.seek(0)
+        for column in list(label_columns) + list(ignore_columns):
+            if column not in columns:
+                raise Exception("no column '" + column + "' in " + str(file_path))
+        if ignore_first_column == True or ignore_columns:
+            columns = [
+                column for i, column in enumerate(columns)
+                if (i > 0 or ignore_first_column != True or column in label_columns) and column not in ignore_columns
+            ]
+            options["usecols"] = columns
+    if values_type == "int":
+        options["dtype"] = np.float32
+    elif values_type == "str":
+        options["dtype"] = "category"
+    if label_columns:
+        dtype = options.pop("dtype", None)
+        options["dtype"] = {
+            column: "category" if column in label_columns else dtype
+            for column in columns if column in label_columns or dtype is not None
+        }
+
+    try:
+        if chunksize is None:
+            chunks = [pd.read_csv(file_path, **options)]
+        else:
+            chunks = pd.read_csv(file_path, chunksize=chunksize, **options)
+
+        for df in chunks:
+            yield df
+    except ValueError as e:
+        # A column that is not a question (ex: a date), or text grades without -T str
+        raise Exception("cannot read the grades of " + str(file_path) + " (" + str(e) + "), ignore the columns "
+                        "that are not questions (--ignore-columns) or read text grades with -T str")
+
+
+# Tally chunks of ballots (DataFrames, or integer arrays of grades when
+# 'questions' is given), returns (questions, counts, invalid summary, rows count)
+def tally_ballot_chunks(chunks, category_names, values_type="int", empty_value_filler=3, questions=None):
+
+    counts = None
+    summary = {"count": 0, "cells": []}
+    row_offset = 0
+    chunks = iter(chunks)
+
+    while True:
+        with profile_stage("read"):
+            df = next(chunks, None)
+        if df is None:
+            break
+        if questions is None:
+            questions = list(df.columns)
+        if counts is None:
+            counts = np.zeros((len(questions), len(category_names)), dtype=np.int64)
+
+        with profile_stage("encode"):
+            codes, values = encode_grades(df, category_names, values_type, empty_value_filler)
+        with profile_stage("tally"):
+            counts += tally_grade_codes(codes, len(category_names))
+
+        # Keep the validation summary bounded across chunks
+        max_cells = MAX_REPORTED_CELLS - len(summary["cells"])
+        with profile_stage("validate"):
+            chunk_summary = check_grade_codes(codes, values, questions, max_cells)
+        for cell in chunk_summary["cells"]:
+            cell["row"] += row_offset
+        summary["count"] += chunk_summary["count"]
+        summary["cells"] += chunk_summary["cells"]
+        row_offset += len(df)
+
+    questions = questions or []
+    if counts is None:
+        counts = np.zeros((len(questions), len(category_names)), dtype=np.int64)
+    return questions, counts, summary, row_offset
+
+
+# Aggregate chunks of ballots into the results dict: {"question": [count, ...], ...}
+def aggregate_ballot_chunks(chunks, category_names, values_type="int", empty_value_filler=3, questions=None):
+    questions, counts, summary, _ = tally_ballot_chunks(
+        chunks, category_names, values_type, empty_value_filler, questions)
+    print_invalid_summary(summary)
+    return dict(zip(questions, counts.tolist()))
+
+
+# With 'chunksize', the CSV is streamed and only the running counts are kept in
+# memory, so the peak memory does not depend on the number of rows.
+def read_and_aggregate_csv(file_path, category_names,ignore_first_column=False, values_type="int", empty_value_filler=3, chunksize=None,
+                           ignore_columns=()):
+    chunks = iter_ballot_chunks(file_path, ignore_first_column, chunksize, values_type, ignore_columns=ignore_columns)
+    return aggregate_ballot_chunks(chunks, category_names, values_type, empty_value_filler)
+
+
+# Tally chunks of ballots by segment, every distinct combination of the values of
+# the 'segment_columns' (ex: team, region), the other columns are the questions.
+# Returns (segments, questions, counts, invalid summary) where 'segments' is the
+# list of (value, ...) tuples in order of appearance and 'counts' a
+# (segments x questions x grades) matrix, counted with one bincount per chunk.
+# An empty segment cell is the value "".
+def tally_segment_chunks(chunks, segment_columns, category_names, values_type="int", empty_value_filler=3):
+    grades_count = len(category_names)
+    segments = {}
+    questions = None
+    counts = None
+    summary = {"count": 0, "cells": []}
+    row_offset = 0
+    chunks = iter(chunks)
+
+    while True:
+        with profile_stage("read"):
+            df = next(chunks, None)
+        if df is None:
+            break
+        if questions is None:
+            questions = [column for column in df.columns if column not in segment_columns]
+            counts = np.zeros((0, len(questions), grades_count), dtype=np.int64)
+
+        with profile_stage("encode"):
+            codes, values = encode_grades(df[questions], category_names, values_type, empty_value_filler)
+            # One integer key per row, mixing the local codes of the segment values
+            # (empty cell: last category), then one global index per distinct key
+            keys = np.zeros(len(df), dtype=np.int64)
+            names = []
+            for column in segment_columns:
+                categorical = df[column].array
+                names.append([str(value) for value in categorical.categories] + [""])
+                keys = keys * len(names[-1]) + np.where(categorical.codes < 0, len(categorical.categories),
+                                                        categorical.codes)
+            distinct, inverse = np.unique(keys, return_inverse=True)
+            indexes = []
+            for key in distinct.tolist():
+                segment = []
+                for column_names in reversed(names):
+                    key, code = divmod(key, len(column_names))
+                    segment.insert(0, column_names[code])
+                indexes.append(segments.setdefault(tuple(segment), len(segments)))
+            segment_ids = np.array(indexes, dtype=np.int64)[inverse.reshape(-1)]
+
+        with profile_stage("tally"):
+            valid = codes >= 0
+            flat = ((segment_ids[:, None] * len(questions) + np.arange(len(questions))) * grades_count + codes)[valid]
+            chunk_counts = np.bincount(flat, minlength=len(segments) * len(questions) * grades_count)
+            if counts.shape[0] < len(segments):
+                counts = np.concatenate([
+                    counts, np.zeros((len(segments) - counts.shape[0], len(questions), grades_count), dtype=np.int64)
+                ])
+            counts += chunk_counts.reshape(len(segments), len(questions), grades_count)
+
+        max_cells = MAX_REPORTED_CELLS - len(summary["cells"])
+        with profile_stage("validate"):
+            chunk_summary = check_grade_codes(codes, values, questions, max_cells)
+        for cell in chunk_summary["cells"]:
+            cell["row"] += row_offset
+        summary["count"] += chunk_summary["count"]
+        summary["cells"] += chunk_summary["cells"]
+        row_offset += len(df)
+
+    questions = questions or []
+    if counts is None:
+        counts = np.zeros((0, len(questions), grades_count), dtype=np.int64)
+    return list(segments), questions, counts, summary
+
+
+# Results of every segment of a CSV file, read once: {(value, ...): results, ...}
+# sorted by segment values.
+def read_and_aggregate_segments(file_path, category_names, segment_columns, ignore_first_column=False,
+                                values_type="int", empty_value_filler=3, chunksize=None, ignore_columns=()):
+    chunks = iter_ballot_chunks(file_path, ignore_first_column, chunksize, values_type, segment_columns,
+                                ignore_columns)
+    segments, questions, counts, summary = tally_segment_chunks(
+        chunks, segment_columns, category_names, values_type, empty_value_filler)
+    print_invalid_summary(summary)
+    return {
+        segment: dict(zip(questions, counts[i].tolist()))
+        for i, segment in sorted(enumerate(segments), key=lambda item: item[1])
+    }
+
+
+# Ballots as timestamped events (seconds), to get the results at any time or
+# over any time window of a long-running poll. The events are kept sorted by
+# time, and the counts of the first k * 'snapshot_every' events are kept
+# (prefix sums): results at a time are a snapshot plus the few events after it.
+# Times are half-open: the results at 't' count the ballots before 't'.
+TIMELINE_SNAPSHOT_EVENTS = 1024
+
+
+class BallotTimeline:
+
+    def __init__(self, questions, category_names, snapshot_every=TIMELINE_SNAPSHOT_EVENTS):
+        self.questions = list(questions)
+        self.category_names = list(category_names)
+        self.snapshot_every = snapshot_every
+        self.size = 0
+        # Events storage, grown by doubling: time, grade codes (-1: not graded)
+        # and weight (1: ballot added, -1: ballot withdrawn)
+        self.times = np.zeros(0, dtype=np.float64)
+        self.codes = np.zeros((0, len(self.questions)), dtype=np.int16)
+        self.weights = np.zeros(0, dtype=np.int8)
+        # Counts of the first i * snapshot_every events, (questions x grades) each
+        self.snapshots = [np.zeros((len(self.questions), len(self.category_names)), dtype=np.int64)]
+
+    def __len__(self):
+        return self.size
+
+    # Add ballots (rows of grade codes) at 'times', weight=-1 withdraws them.
+    # Appending in time order only counts the new events, older events are
+    # inserted at their place and the snapshots after them are counted again.
+    def add(self, times, codes, weight=1):
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        codes = np.asarray(codes, dtype=np.int16).reshape(len(times), len(self.questions))
+        if not len(times):
+            return
+        if np.isnan(times).any():
+            raise Exception("ballot times must be numbers of seconds")
+        order = np.argsort(times, kind="stable")
+        times, codes = times[order], codes[order]
+
+        size = self.size + len(times)
+        if size > len(self.times):
+            capacity = max(size, 2 * len(self.times), 1024)
+            self.times = np.resize(self.times, capacity)
+            self.codes = np.resize(self.codes, (capacity, len(self.questions)))
+            self.weights = np.resize(self.weights, capacity)
+        first = np.searchsorted(self.times[:self.size], times[0], side="right")
+        self.times[self.size:size] = times
+        self.codes[self.size:size] = codes
+        self.weights[self.size:size] = weight
+        if first < self.size:
+            order = np.argsort(self.times[:size], kind="stable")
+            self.times[:size] = self.times[order]
+            self.codes[:size] = self.codes[order]
+            self.weights[:size] = self.weights[order]
+            del self.snapshots[first // self.snapshot_every + 1:]
+        self.size = size
+
+        while len(self.snapshots) * self.snapshot_every <= self.size:
+            start = (len(self.snapshots) - 1) * self.snapshot_every
+            self.snapshots.append(self.snapshots[-1] + self._count(start, start + self.snapshot_every)[0])
+
+    # Weighted counts of the events [start, end), (bins x questions x grades)
+    # where 'bins' is the bin of each event, all in the first bin by default
+    def _count(self, start, end, bins=None, bins_count=1):
+        questions_count, grades_count = len(self.questions), len(self.category_names)
+        codes = self.codes[start:end].astype(np.int64)
+        valid = codes >= 0
+        flat = codes + np.arange(questions_count) * grades_count
+        if bins is not None:
+            flat += bins[:, None] * questions_count * grades_count
+        weights = np.broadcast_to(self.weights[start:end, None], codes.shape)[valid]
+        counts = np.bincount(flat[valid], weights=weights, minlength=bins_count * questions_count * grades_count)
+        return counts.astype(np.int64).reshape(bins_count, questions_count, grades_count)
+
+    # Counts of the ballots before 'time' (every ballot when None)
+    def counts_at(self, time=None):
+        end = self.size if time is None else int(np.searchsorted(self.times[:self.size], time, side="left"))
+        k = end // self.snapshot_every
+        return self.snapshots[k] + self._count(k * self.snapshot_every, end)[0]
+
+    # Results of the ballots of the window [start, end), every ballot by default
+    def results(self, start=None, end=None):
+        counts = self.counts_at(end)
+        if start is not None:
+            counts = counts - self.counts_at(start)
+        return dict(zip(self.questions, counts.tolist()))
+
+    # Counts (times x questions x grades) and majority grades (times x questions)
+    # of the ballots from 'start' and before each of the sorted 'times', in one
+    # pass over the events
+    def time_series(self, times, start=None):
+        times = np.asarray(times, dtype=np.float64)
+        bins = np.searchsorted(times, self.times[:self.size], side="right")
+        counts = self._count(0, self.size, bins, len(times) + 1)[:len(times)].cumsum(axis=0)
+        if start is not None:
+            counts -= self.counts_at(start)
+        cumulative = counts.cumsum(axis=2)
+        grades = np.argmax(2 * cumulative >= cumulative[:, :, -1:], axis=2)
+        return counts, grades
+
+    # Period ends of a time series every 'interval' seconds, aligned on
+    # multiples of 'interval' (ex: midnights UTC for one day), up to the last ballot
+    def periods(self, interval):
+        if not self.size:
+            return np.zeros(0)
+        first = np.floor(self.times[0] / interval) * interval
+        count = int(np.floor((self.times[self.size - 1] - first) / interval)) + 1
+        return first + interval * np.arange(1, count + 1)
+
+
+# Seconds of times given as dates (UTC unless stated) or as numbers of seconds,
+# rows are numbered from 'row_offset' in the errors
+def parse_times(values, row_offset=0):
+    import pandas as pd
+
+    categorical = pd.Categorical(values)
+    categories = categorical.categories.astype(str)
+    seconds = pd.to_numeric(categories, errors="coerce")
+    if np.isnan(np.asarray(seconds, dtype=np.float64)).any():
+        dates = pd.to_datetime(categories, utc=True, errors="coerce", format="mixed")
+        seconds = (dates - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)
+    seconds = np.append(np.asarray(seconds, dtype=np.float64), np.nan)
+    times = seconds[categorical.codes]
+    bad = np.flatnonzero(np.isnan(times))
+    if len(bad):
+        value = categorical[bad[0]]
+        raise Exception("row %d: %r is not a time" % (bad[0] + row_offset, "" if pd.isna(value) else value))
+    return times
+
+
+def format_time(seconds):
+    import pandas as pd
+
+    return pd.Timestamp(seconds, unit="s", tz="UTC").isoformat()
+
+
+# Timeline of the ballots of a CSV file, timed by its 'time_column'
+def read_timeline_csv(file_path, time_column, category_names, ignore_first_column=False, values_type="int",
+                      empty_value_filler=3, chunksize=None, ignore_columns=()):
+    chunks = iter_ballot_chunks(file_path, ignore_first_column, chunksize, values_type, (time_column,),
+                                ignore_columns)
+    timeline = None
+    summary = {"count": 0, "cells": []}
+    row_offset = 0
+    for df in chunks:
+        questions = [column for column in df.columns if column != time_column]
+        if timeline is None:
+            timeline = BallotTimeline(questions, category_names)
+        with profile_stage("encode"):
+            codes, values = encode_grades(df[questions], category_names, values_type, empty_value_filler)
+            times = parse_times(df[time_column], row_offset)
+        with profile_stage("tally"):
+            timeline.add(times, codes)
+        max_cells = MAX_REPORTED_CELLS - len(summary["cells"])
+        with profile_stage("validate"):
+            chunk_summary = check_grade_codes(codes, values, questions, max_cells)
+        for cell in chunk_summary["cells"]:
+            cell["row"] += row_offset
+        summary["count"] += chunk_summary["count"]
+        summary["cells"] += chunk_summary["cells"]
+        row_offset += len(df)
+    print_invalid_summary(summary)
+    return timeline or BallotTimeline([], category_names)
+
+
+# Maximum size of a shard of the parallel aggregation, so that the memory of a
+# worker does not depend on the size of the file
+SHARD_BYTES = 64 * 1024 * 1024
+
+
+# Split a CSV file into byte ranges of about 'shard_bytes', each one starting and
+# ending on a row boundary. A newline inside a quoted field is not a row
+# boundary: the number of quotes before a boundary must be even.
+# Returns (header bytes, [(start, end), ...]).
+def csv_shards(file_path, shard_bytes=SHARD_BYTES):
+    import mmap
+
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return b"", []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            boundaries = [0]
+            quotes = 0
+            # The first range is the header row
+            step = 1
+            while boundaries[-1] < size:
+                start = boundaries[-1]
+                position = min(start + step, size) - 1
+                quotes += data[start:position].count(b'"')
+                while True:
+                    newline = data.find(b"\n", position)
+                    end = size if newline < 0 else newline + 1
+                    quotes += data[position:end].count(b'"')
+                    position = end
+                    if quotes % 2 == 0 or position == size:
+                        break
+                boundaries.append(position)
+                step = shard_bytes
+            header = data[:boundaries[1]]
+
+    return header, list(zip(boundaries[1:-1], boundaries[2:]))
+
+
+# Tally the rows of a byte range of a CSV file (a shard), in a worker process
+def tally_csv_shard(file_path, header, start, end, category_names, ignore_first_column=False,
+                    values_type="int", empty_value_filler=3, chunksize=None, ignore_columns=()):
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        data = io.BytesIO(header + file.read(end - start))
+    chunks = iter_ballot_chunks(data, ignore_first_column, chunksize, values_type, ignore_columns=ignore_columns)
+    return tally_ballot_chunks(chunks, category_names, values_type, empty_value_filler)
+
+
+# Same results as read_and_aggregate_csv, the file is split into row-aligned
+# shards tallied by a pool of 'jobs' processes (default: one per core)
+def parallel_read_and_aggregate_csv(file_path, category_names, ignore_first_column=False, values_type="int",
+                                    empty_value_filler=3, chunksize=None, jobs=None, shard_bytes=SHARD_BYTES,
+                                    ignore_columns=()):
+    jobs = jobs or os.cpu_count()
+    size = os.path.getsize(file_path)
+    # At least one shard per worker
+    header, shards = csv_shards(file_path, max(1, min(shard_bytes, size // jobs)))
+    if not shards:
+        return read_and_aggregate_csv(file_path, category_names, ignore_first_column, values_type,
+                                      empty_value_filler, chunksize, ignore_columns)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(shards))) as pool:
+        futures = [
+            pool.submit(tally_csv_shard, file_path, header, start, end, category_names,
+                        ignore_first_column, values_type, empty_value_filler, chunksize, ignore_columns)
+            for start, end in shards
+        ]
+        # Reduce in the shards order, so that invalid cells keep their row numbers
+        counts = None
+        summary = {"count": 0, "cells": []}
+        row_offset = 0
+        for future in futures:
+            questions, shard_counts, shard_summary, rows = future.result()
+            counts = shard_counts if counts is None else counts + shard_counts
+            for cell in shard_summary["cells"][:MAX_REPORTED_CELLS - len(summary["cells"])]:
+                cell["row"] += row_offset
+                summary["cells"].append(cell)
+            summary["count"] += shard_summary["count"]
+            row_offset += rows
+
+    print_invalid_summary(summary)
+    return dict(zip(questions, counts.tolist()))
+
+
+# Ballot cache files: a CSV converted once into columns of small integers,
+# tallied again and again with any categories, filler or -I from a memory map.
+# Each column stores the index of every cell in the column's distinct values
+# (0 for an empty cell, i + 1 for values[i]), as uint8 or uint16:
+#   MAGIC, metadata length (8 bytes, little endian), JSON metadata, columns data
+#   metadata => {"source": {"size": ..., "mtime_ns": ...}, "rows": N,
+#                "columns": [{"name": "Q1", "values": ["1", "2", ...], "dtype": "uint8", "offset": ...}, ...]}
+# Columns with more distinct values (ex: timestamps) are not stored ("dtype": null).
+BALLOT_CACHE_MAGIC = b"MJCACHE1"
+BALLOT_CACHE_MAX_VALUES = 65535
+
+
+def ballot_cache_path(file_path):
+    return file_path + ".mjc"
+
+
+def csv_signature(file_path):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+# Convert a CSV file into a ballot cache file, by chunks of 'chunksize' rows
+def write_ballot_cache(file_path, cache_path=None, chunksize=100000):
+    import pandas as pd
+
+    cache_path = cache_path or ballot_cache_path(file_path)
+    signature = csv_signature(file_path)
+    names = None
+    # Distinct values of each column: [{value: index + 1}, ...], None once too many
+    lookups = []
+    columns = []
+    rows = 0
+    for df in pd.read_csv(file_path, dtype="category", chunksize=chunksize):
+        if names is None:
+            names = list(df.columns)
+            lookups = [{} for _ in names]
+            columns = [[] for _ in names]
+        for i, name in enumerate(names):
+            if lookups[i] is None:
+                continue
+            categorical = df[name].array
+            lookup = lookups[i]
+            mapping = np.array([0] + [lookup.setdefault(str(value), len(lookup) + 1)
+                                      for value in categorical.categories], dtype=np.int64)
+            if len(lookup) > BALLOT_CACHE_MAX_VALUES:
+                lookups[i], columns[i] = None, None
+                continue
+            # Category code -1 (empty cell) maps to the first item, 0
+            columns[i].append(mapping[np.asarray(categorical.codes, dtype=np.int64) + 1].astype(np.uint16))
+        rows += len(df)
+
+    names = names or list(pd.read_csv(file_path, nrows=0).columns)
+    metadata = {"source": signature, "rows": rows, "columns": []}
+    arrays = []
+    offset = 0
+    for i, name in enumerate(names):
+        column = {"name": name, "values": None, "dtype": None, "offset": None}
+        if lookups and lookups[i] is not None:
+            data = np.concatenate(columns[i]) if columns[i] else np.zeros(0, dtype=np.uint16)
+            dtype = np.uint8 if len(lookups[i]) < 256 else np.uint16
+            column.update(values=list(lookups[i]), dtype=np.dtype(dtype).name, offset=offset)
+            arrays.append(data.astype(dtype))
+            # Columns are aligned on 64 bytes
+            offset += -(-arrays[-1].nbytes // 64) * 64
+        metadata["columns"].append(column)
+
+    header = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(BALLOT_CACHE_MAGIC + len(header).to_bytes(8, "little") + header)
+        for array in arrays:
+            file.write(b"\0" * (-file.tell() % 64))
+            file.write(array.tobytes())
+    os.replace(temporary_path, cache_path)
+    return cache_path
+
+
+# Memory map a ballot cache file, None when it is missing, invalid or older than the CSV:
+#   {"rows": N, "columns": [{"name": "Q1", "values": [...], "codes": np.memmap or None}, ...]}
+def load_ballot_cache(file_path, cache_path=None):
+    cache_path = cache_path or ballot_cache_path(file_path)
+    try:
+        with open(cache_path, "rb") as file:
+            if file.read(len(BALLOT_CACHE_MAGIC)) != BALLOT_CACHE_MAGIC:
+                return None
+            header_length = int.from_bytes(file.read(8), "little")
+            metadata = json.loads(file.read(header_length))
+    except (OSError, ValueError):
+        return None
+    if metadata["source"] != csv_signature(file_path):
+        return None
+
+    data_start = -(-(len(BALLOT_CACHE_MAGIC) + 8 + header_length) // 64) * 64
+    columns = []
+    for column in metadata["columns"]:
+        codes = None
+        if column["dtype"] is not None and metadata["rows"]:
+            codes = np.memmap(cache_path, dtype=column["dtype"], mode="r",
+                              offset=data_start + column["offset"], shape=(metadata["rows"],))
+        elif column["dtype"] is not None:
+            codes = np.zeros(0, dtype=column["dtype"])
+        columns.append({"name": column["name"], "values": column["values"], "codes": codes})
+    return {"rows": metadata["rows"], "columns": columns}
+
+
+# Grade code of every distinct value of a cached column (first item: empty cell)
+def cached_value_codes(values, category_names, values_type="int", empty_value_filler=3):
+    if values_type == "int":
+        def code(value):
+            try:
+                grade = int(float(value))
+            except ValueError:
+                raise Exception("'" + value + "' is not an integer grade, try -T str")
+            return grade - 1 if 1 <= grade <= len(category_names) else -1
+        return np.array([code(str(empty_value_filler))] + [code(value) for value in values], dtype=np.int64)
+    elif values_type == "str":
+        lookup = {str(name): code for code, name in enumerate(category_names)}
+        return np.array([lookup.get(str(empty_value_filler), -1)] + [lookup.get(value, -1) for value in values],
+                        dtype=np.int64)
+    raise Exception("values_type='" + values_type + "' is not supported, try 'int' or 'str'")
+
+
+# Same results as read_and_aggregate_csv, from a loaded ballot cache. Every
+# column is counted with one bincount on the memory map, then its few distinct
+# values are mapped to grades. None when a needed column is not cached.
+def aggregate_ballot_cache(cache, category_names, ignore_first_column=False, values_type="int", empty_value_filler=3,
+                           ignore_columns=()):
+    columns = cache["columns"][1:] if ignore_first_column else cache["columns"]
+    names = [column["name"] for column in cache["columns"]]
+    for name in ignore_columns:
+        if name not in names:
+            raise Exception("no column '" + name + "' in the ballot cache")
+    columns = [column for column in columns if column["name"] not in ignore_columns]
+    if any(column["codes"] is None for column in columns):
+        return None
+
+    grades_count = len(category_names)
+    counts = np.zeros((len(columns), grades_count), dtype=np.int64)
+    invalid_count = 0
+    invalid_cells = []
+    with profile_stage("tally"):
+        for i, column in enumerate(columns):
+            value_codes = cached_value_codes(column["values"], category_names, values_type, empty_value_filler)
+            value_counts = np.bincount(column["codes"], minlength=len(value_codes))
+            valid = value_codes >= 0
+            counts[i] = np.bincount(value_codes[valid], weights=value_counts[valid], minlength=grades_count)
+            invalid = value_counts[~valid].sum()
+            if invalid:
+                invalid_count += int(invalid)
+                # First invalid cells of the column, to report them by rows
+                rows = np.flatnonzero(~valid[column["codes"]])[:MAX_REPORTED_CELLS]
+                invalid_cells += [(int(row), i) for row in rows]
+
+    cells = []
+    for row, i in sorted(invalid_cells)[:MAX_REPORTED_CELLS]:
+        # Reported as read_and_aggregate_csv does
+        raw = columns[i]["codes"][row]
+        if values_type == "int":
+            value = int(float(empty_value_filler if raw == 0 else columns[i]["values"][raw - 1]))
+        else:
+            value = float("nan") if raw == 0 else columns[i]["values"][raw - 1]
+        cells.append({"row": row, "question": columns[i]["name"], "value": value})
+    print_invalid_summary({"count": invalid_count, "cells": cells})
+    return dict(zip([column["name"] for column in columns], counts.tolist()))
+
+
+# read_and_aggregate_csv through the ballot cache of the CSV, (re)built when it
+# is missing or older than the CSV
+def cached_read_and_aggregate_csv(file_path, category_names, ignore_first_column=False, values_type="int",
+                                  empty_value_filler=3, chunksize=None, cache_path=None, ignore_columns=()):
+    cache = load_ballot_cache(file_path, cache_path)
+    if cache is None:
+        with profile_stage("read"):
+            write_ballot_cache(file_path, cache_path, chunksize or 100000)
+        cache = load_ballot_cache(file_path, cache_path)
+    results = aggregate_ballot_cache(cache, category_names, ignore_first_column, values_type, empty_value_filler,
+                                     ignore_columns)
+    if results is None:
+        # A column with too many distinct values to be cached is needed
+        return read_and_aggregate_csv(file_path, category_names, ignore_first_column, values_type,
+                                      empty_value_filler, chunksize, ignore_columns)
+    return results
+
+
+# End of the last complete row of 'data' (which starts on a row boundary), a
+# newline inside a quoted field does not end a row. 0 without complete row.
+def complete_rows_end(data):
+    end = data.rfind(b"\n")
+    while end >= 0:
+        if data[:end + 1].count(b'"') % 2 == 0:
+            return end + 1
+        end = data.rfind(b"\n", 0, end)
+    return 0
+
+
+# Running tallies of a growing CSV file: every update() only parses the rows
+# appended since the previous one, by blocks of at most 'block_bytes'. A file
+# rewritten from the start (a new export) is tallied again. A last row without
+# newline is counted once the file size did not change between two updates,
+# and counted again if the file grows (the row was incomplete).
+class CsvWatcher:
+
+    def __init__(self, file_path, category_names, ignore_first_column=False, values_type="int",
+                 empty_value_filler=3, block_bytes=SHARD_BYTES, ignore_columns=()):
+        self.file_path = file_path
+        self.category_names = category_names
+        self.ignore_first_column = ignore_first_column
+        self.ignore_columns = ignore_columns
+        self.values_type = values_type
+        self.empty_value_filler = empty_value_filler
+        self.block_bytes = block_bytes
+        self.reset()
+
+    def reset(self):
+        self.header = None
+        self.questions = []
+        self.counts = np.zeros((0, len(self.category_names)), dtype=np.int64)
+        self.rows = 0
+        # Bytes read so far (complete rows only), and their last bytes to notice a rewrite
+        self.offset = 0
+        self.last_bytes = b""
+        # File size at the previous update, and (counts, rows) of the last row
+        # without newline when it is counted
+        self.size = None
+        self.tail = None
+
+    def results(self):
+        return dict(zip(self.questions, self.counts.tolist()))
+
+    # Tally the rows of 'data' (complete rows), returns (counts, rows)
+    def _tally_rows(self, data):
+        chunks = iter_ballot_chunks(io.BytesIO(self.header + data), self.ignore_first_column,
+                                    None, self.values_type, ignore_columns=self.ignore_columns)
+        _, counts, summary, rows = tally_ballot_chunks(
+            chunks, self.category_names, self.values_type, self.empty_value_filler)
+        for cell in summary["cells"]:
+            cell["row"] += self.rows
+        print_invalid_summary(summary)
+        return counts, rows
+
+    # Tally the new complete rows, returns True when the counts changed
+    def update(self):
+        changed = False
+        with open(self.file_path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if self.tail is not None and size != self.size:
+                # The counted last row was incomplete, it is read again
+                counts, rows = self.tail
+                self.tail = None
+                self.counts -= counts
+                self.rows -= rows
+                changed = bool(counts.any())
+            if self.offset:
+                file.seek(self.offset - len(self.last_bytes))
+                if size < self.offset or file.read(len(self.last_bytes)) != self.last_bytes:
+                    # Rewritten file: the counts cleared are a change too
+                    changed = changed or bool(self.counts.any())
+                    self.reset()
+            if self.header is None:
+                # The header is the first complete row
+                block_bytes = self.block_bytes
+                while True:
+                    file.seek(0)
+                    data = file.read(block_bytes)
+                    end = data.find(b"\n")
+                    while end >= 0 and data[:end + 1].count(b'"') % 2:
+                        end = data.find(b"\n", end + 1)
+                    if end >= 0 or len(data) < block_bytes:
+                        break
+                    block_bytes *= 2
+                if end < 0:
+                    self.size = size
+                    return changed
+                self.header = data[:end + 1]
+                self.offset = len(self.header)
+                self.last_bytes = self.header[-64:]
+                self.questions, self.counts, _, _ = tally_csv_shard(
+                    self.file_path, self.header, 0, 0, self.category_names, self.ignore_first_column,
+                    self.values_type, self.empty_value_filler, ignore_columns=self.ignore_columns)
+
+            block_bytes = self.block_bytes
+            while self.offset < size:
+                file.seek(self.offset)
+                data = file.read(block_bytes)
+                end = complete_rows_end(data)
+                if end == 0:
+                    # A row larger than the block, or an incomplete last row
+                    if len(data) < block_bytes:
+                        break
+                    block_bytes *= 2
+                    continue
+                counts, rows = self._tally_rows(data[:end])
+                changed = changed or bool(counts.any())
+                self.counts += counts
+                self.rows += rows
+                self.offset += end
+                self.last_bytes = data[max(0, end - 64):end]
+
+            if self.tail is None and self.offset < size and size == self.size:
+                # A finished file without a newline at the end
+                file.seek(self.offset)
+                counts, rows = self._tally_rows(file.read(size - self.offset) + b"\n")
+                changed = changed or bool(counts.any())
+                self.counts += counts
+                self.rows += rows
+                self.tail = (counts, rows)
+            self.size = size
+        return changed
+
+
+# Tally a growing CSV file every 'interval' seconds, and call on_change(results)
+# when the counts changed, at most every 'debounce' seconds: a change waits
+# 'debounce' seconds for the following ones. Stops on Ctrl+C.
+def watch_csv(file_path, category_names, on_change, ignore_first_column=False, values_type="int",
+              empty_value_filler=3, interval=1.0, debounce=2.0, ignore_columns=()):
+    watcher = CsvWatcher(file_path, category_names, ignore_first_column, values_type, empty_value_filler,
+                         ignore_columns=ignore_columns)
+    last_results = None
+    changed_at = None
+    try:
+        while True:
+            if watcher.update() and changed_at is None:
+                changed_at = time.monotonic()
+            if changed_at is not None and time.monotonic() - changed_at >= debounce:
+                changed_at = None
+                results = watcher.results()
+                # Appended rows of invalid values only do not change anything
+                if results != last_results:
+                    last_results = results
+                    on_change(results)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return watcher.results()
+
+
+# Group an iterable of ballots (dicts or tuples) into DataFrames of 'chunksize' rows
+def iter_record_chunks(ballots, questions, chunksize):
+    import pandas as pd
+
+    batch = []
+    for ballot in ballots:
+        if questions is None:
+            if not isinstance(ballot, dict):
+                raise Exception("'questions' is required for ballots given as tuples")
+            questions = list(ballot.keys())
+        batch.append(ballot)
+        if len(batch) == chunksize:
+            yield pd.DataFrame.from_records(batch, columns=questions)
+            batch = []
+    if batch:
+        yield pd.DataFrame.from_records(batch, columns=questions)
+
+
+# In-memory counterpart of read_and_aggregate_csv, 'ballots' can be:
+#   - a pandas DataFrame, one column per question
+#   - a 2-D NumPy array of grades (1 to len(category_names) for 'int'), with
+#     one column per question named by 'questions' (default: Q1, Q2, ...)
+#   - an iterable of ballots, dicts {"question": grade} or tuples of grades
+#     ordered as 'questions', read by chunks of 'chunksize' ballots
+#     (questions default to the keys of the first dict)
+# Missing grades are filled with 'empty_value_filler' as in the CSV case.
+def aggregate_ballots(ballots, category_names, values_type="int", empty_value_filler=3, questions=None, chunksize=10000):
+    import pandas as pd
+
+    if isinstance(ballots, pd.DataFrame):
+        chunks = [ballots]
+        questions = None
+
+    elif isinstance(ballots, np.ndarray):
+        if ballots.ndim != 2:
+            raise Exception("ballots array must be 2-D (voters x questions)")
+        if questions is None:
+            questions = ["Q" + str(i + 1) for i in range(ballots.shape[1])]
+        if values_type == "int" and np.issubdtype(ballots.dtype, np.integer):
+            chunks = [ballots]
+        else:
+            chunks = [pd.DataFrame(ballots, columns=questions, copy=False)]
+
+    else:
+        chunks = iter_record_chunks(ballots, questions, chunksize)
+        # Questions are known once the first ballot has been read
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return {question: [0] * len(category_names) for question in questions or []}
+        questions = list(first_chunk.columns)
+        chunks = itertools.chain([first_chunk], chunks)
+
+    return aggregate_ballot_chunks(chunks, category_names, values_type, empty_value_filler, questions)
+
+
+
+# Majority grade index of every question, i.e. the lower median segment that
+# survey() highlights as "Major"
+def majority_grades(results):
+    counts = np.array(list(results.values()), dtype=np.int64).reshape(len(results), -1)
+    cumulative = counts.cumsum(axis=1)
+    return np.argmax(2 * cumulative >= cumulative[:, -1:], axis=1)
+
+
+# Sort keys of the majority judgment tie-breaking, for every question at once.
+# Each step records the median grade and the signed share of the larger side
+# (above: positive, below: negative), then merges the median group into the
+# adjacent grade of that side. Comparing these keys lexicographically gives the
+# same order as the repeated median removal ("majority value").
+def majority_ranking_keys(counts):
+    counts = np.array(counts, dtype=np.int64)
+    candidates_count, grades_count = counts.shape
+    total = counts.sum(axis=1)
+    scale = np.where(total == 0, 1, total)
+    rows = np.arange(candidates_count)
+
+    keys = []
+    for _ in range(grades_count * grades_count):
+        cumulative = counts.cumsum(axis=1)
+        median = np.argmax(2 * cumulative >= total[:, None], axis=1)
+        below = cumulative[rows, median] - counts[rows, median]
+        above = total - cumulative[rows, median]
+        upward = above > below
+
+        keys.append(median)
+        if not (above + below).any():
+            break
+        # Rounded shares, so that equal proportions compare equal
+        keys.append(np.round(np.where(upward, above, -below) / scale, 12))
+
+        target = np.clip(np.where(upward, median + 1, median - 1), 0, grades_count - 1)
+        moved = counts[rows, median].copy()
+        counts[rows, median] = 0
+        counts[rows, target] += moved
+    return keys
+
+
+# Rank the questions by majority judgment, best first:
+#   [(rank, question, majority grade index), ...]
+# Ex aequo questions share the same rank.
+def majority_ranking(results):
+    labels = list(results.keys())
+    if not labels:
+        return []
+    counts = np.array(list(results.values()), dtype=np.int64).reshape(len(labels), -1)
+    keys = majority_ranking_keys(counts)
+    order = np.lexsort([-key for key in reversed(keys)])
+
+    sorted_keys = np.array(keys)[:, order]
+    new_rank = np.ones(len(order), dtype=bool)
+    new_rank[1:] = (sorted_keys[:, 1:] != sorted_keys[:, :-1]).any(axis=0)
+    ranks = np.maximum.accumulate(np.where(new_rank, np.arange(1, len(order) + 1), 0))
+
+    return [(int(rank), labels[i], int(keys[0][i])) for rank, i in zip(ranks, order)]
+
+
+# Resampled tallies per batch, bounds the memory of robustness()
+ROBUSTNESS_BATCH = 1000
+
+
+# Bootstrap of the majority grades and of the ranking: every question's tally
+# is redrawn 'samples' times from a multinomial of its own size and grade
+# shares (questions are resampled independently). Returns, for each question,
+# the probability of each majority grade and of each rank position:
+#   {"question": {"majority_grade": [p of category 0, ...], "rank": [p of rank 1, ...]}, ...}
+def robustness(results, samples=1000, seed=None, batch=ROBUSTNESS_BATCH):
+    labels = list(results.keys())
+    if not labels or samples <= 0:
+        return {label: {"majority_grade": [], "rank": []} for label in labels}
+    counts = np.array(list(results.values()), dtype=np.int64).reshape(len(labels), -1)
+    questions_count, grades_count = counts.shape
+    total = counts.sum(axis=1)
+    shares = counts / np.where(total == 0, 1, total)[:, None]
+    shares[total == 0] = 1 / grades_count
+
+    rng = np.random.default_rng(seed)
+    grade_hits = np.zeros((questions_count, grades_count), dtype=np.int64)
+    rank_hits = np.zeros((questions_count, questions_count), dtype=np.int64)
+    questions = np.arange(questions_count)
+
+    for start in range(0, samples, batch):
+        size = min(batch, samples - start)
+        # (size x questions x grades) resampled tallies
+        drawn = rng.multinomial(total, shares, size=(size, questions_count))
+
+        keys = np.array(majority_ranking_keys(drawn.reshape(-1, grades_count)))
+        keys = keys.reshape(len(keys), size, questions_count)
+        medians = keys[0].astype(np.int64)
+        grade_hits += np.bincount((questions * grades_count + medians).ravel(),
+                                  minlength=questions_count * grades_count).reshape(questions_count, grades_count)
+
+        # Competition ranks of every sample, as in majority_ranking()
+        order = np.lexsort(-keys[::-1], axis=-1)
+        sorted_keys = np.take_along_axis(keys, order[None], axis=-1)
+        new_rank = np.ones((size, questions_count), dtype=bool)
+        new_rank[:, 1:] = (sorted_keys[:, :, 1:] != sorted_keys[:, :, :-1]).any(axis=0)
+        ranks = np.maximum.accumulate(np.where(new_rank, np.arange(questions_count), 0), axis=1)
+        question_ranks = np.empty_like(ranks)
+        np.put_along_axis(question_ranks, order, ranks, axis=1)
+        rank_hits += np.bincount((questions * questions_count + question_ranks).ravel(),
+                                 minlength=questions_count * questions_count).reshape(questions_count, questions_count)
+
+    return {
+        label: {"majority_grade": (grade_hits[i] / samples).tolist(), "rank": (rank_hits[i] / samples).tolist()}
+        for i, label in enumerate(labels)
+    }
 
 
-def survey(results, category_names, title, display_major=True, plot=True):
+# Print the non-zero probabilities of robustness(), in the ranking order
+def print_robustness(robustness, category_names, ranking):
+    for _, label, _ in ranking:
+        grades = ", ".join("%s %.1f%%" % (category_names[grade], 100 * p)
+                           for grade, p in enumerate(robustness[label]["majority_grade"]) if p > 0)
+        ranks = ", ".join("#%d %.1f%%" % (rank + 1, 100 * p)
+                          for rank, p in enumerate(robustness[label]["rank"]) if p > 0)
+        print("%s\n  majority grade: %s\n  rank: %s" % (label, grades, ranks))
+
+
+def print_ranking(ranking, category_names):
+    for rank, label, grade in ranking:
+        print("%d. %s (%s)" % (rank, label, category_names[grade]))
+
+
+# Ranking as JSON serializable records
+def ranking_records(results, category_names):
+    return [
+        {"rank": rank, "question": label, "majority_grade": str(category_names[grade])}
+        for rank, label, grade in majority_ranking(results)
+    ]
+
+
+# Machine readable tallies and ranking (no chart, matplotlib is not loaded)
+def write_results_json(results, category_names, file=sys.stdout, robustness=None):
+    document = {
+        "categories": [str(name) for name in category_names],
+        "results": results,
+        "ranking": ranking_records(results, category_names),
+    }
+    if robustness is not None:
+        document["robustness"] = robustness
+    json.dump(document, file, ensure_ascii=False)
+    file.write("\n")
+
+
+# One row per question, in ranking order: question,rank,majority_grade,<count of each category>
+def write_results_csv(results, category_names, file=sys.stdout):
+    writer = csv.writer(file)
+    writer.writerow(["question", "rank", "majority_grade"] + [str(name) for name in category_names])
+    for rank, label, grade in majority_ranking(results):
+        writer.writerow([label, rank, category_names[grade]] + list(results[label]))
+
+
+# Segment label of the charts and of the printed rankings: "team: A, region: EU"
+def segment_label(segment_columns, segment):
+    return ", ".join("%s: %s" % (column, value) for column, value in zip(segment_columns, segment))
+
+
+# Segmented results (see read_and_aggregate_segments) as JSON:
+#   {"categories": [...], "segment_columns": ["team"],
+#    "segments": [{"segment": {"team": "A"}, "voters": 12, "results": {...}, "ranking": [...]}, ...]}
+def write_segments_json(segments, segment_columns, category_names, file=sys.stdout):
+    document = {
+        "categories": [str(name) for name in category_names],
+        "segment_columns": list(segment_columns),
+        "segments": [
+            {
+                "segment": dict(zip(segment_columns, segment)),
+                "voters": max([sum(counts) for counts in results.values()], default=0),
+                "results": results,
+                "ranking": ranking_records(results, category_names),
+            }
+            for segment, results in segments.items()
+        ],
+    }
+    json.dump(document, file, ensure_ascii=False)
+    file.write("\n")
+
+
+# One row per segment and question, in ranking order within each segment:
+# <segment columns>,question,rank,majority_grade,<count of each category>
+def write_segments_csv(segments, segment_columns, category_names, file=sys.stdout):
+    writer = csv.writer(file)
+    writer.writerow(list(segment_columns) + ["question", "rank", "majority_grade"]
+                    + [str(name) for name in category_names])
+    for segment, results in segments.items():
+        for rank, label, grade in majority_ranking(results):
+            writer.writerow(list(segment) + [label, rank, category_names[grade]] + list(results[label]))
+
+
+# Majority grade of every question at each of the sorted 'times' (ballots
+# from 'start' and before it), one row per time: time,voters,<majority grade of each question>
+def write_time_series_csv(timeline, times, start=None, file=sys.stdout):
+    counts, grades = timeline.time_series(times, start)
+    writer = csv.writer(file)
+    writer.writerow(["time", "voters"] + timeline.questions)
+    for time_, time_counts, time_grades in zip(times, counts, grades):
+        writer.writerow([format_time(time_), int(time_counts.sum(axis=1).max(initial=0))]
+                        + [timeline.category_names[grade] for grade in time_grades])
+
+
+#   {"categories": [...], "questions": [...], "times": ["2024-01-01T00:00:00+00:00", ...],
+#    "voters": [...], "majority_grades": {"question": [grade at each time, ...]}}
+def write_time_series_json(timeline, times, start=None, file=sys.stdout):
+    counts, grades = timeline.time_series(times, start)
+    document = {
+        "categories": [str(name) for name in timeline.category_names],
+        "questions": timeline.questions,
+        "times": [format_time(time_) for time_ in times],
+        "voters": counts.sum(axis=2).max(axis=1, initial=0).tolist(),
+        "majority_grades": {
+            question: [str(timeline.category_names[grade]) for grade in grades[:, i]]
+            for i, question in enumerate(timeline.questions)
+        },
+    }
+    json.dump(document, file, ensure_ascii=False)
+    file.write("\n")
+
+
+# Tally files hold only the per-question grade counts, they are the exchange
+# format between collection nodes and the renderer:
+#   {"format": "majority-judgment-tallies", "version": 1,
+#    "categories": ["1", "2", ...], "voters": 120,
+#    "questions": [{"question": "Q1", "voters": 120, "counts": [10, 20, ...]}, ...]}
+# The voters of a question are its counted grades, the file 'voters' is their maximum.
+TALLY_FORMAT = "majority-judgment-tallies"
+TALLY_VERSION = 1
+
+
+def write_tally_file(results, category_names, file_path):
+    questions = [
+        {"question": question, "voters": int(sum(counts)), "counts": [int(count) for count in counts]}
+        for question, counts in results.items()
+    ]
+    with open(file_path, "w", encoding="utf-8") as file:
+        json.dump({
+            "format": TALLY_FORMAT,
+            "version": TALLY_VERSION,
+            "categories": [str(name) for name in category_names],
+            "voters": max([question["voters"] for question in questions], default=0),
+            "questions": questions,
+        }, file, ensure_ascii=False)
+        file.write("\n")
+
+
+# Return (results, category_names) of a tally file
+def read_tally_file(file_path):
+    with open(file_path, encoding="utf-8") as file:
+        document = json.load(file)
+    if document.get("format") != TALLY_FORMAT or document.get("version") != TALLY_VERSION:
+        raise Exception(file_path + " is not a tally file (version " + str(TALLY_VERSION) + ")")
+
+    category_names = document["categories"]
+    results = {}
+    for question in document["questions"]:
+        counts = question["counts"]
+        if len(counts) != len(category_names):
+            raise Exception(file_path + ": question '" + question["question"]
+                            + "' does not have one count per category")
+        results[question["question"]] = counts
+    return results, category_names
+
+
+# Add tally files together, questions missing from a file count as zeros.
+# Every file must have the same grade scale.
+def merge_tally_files(file_paths):
+    counts = None
+    questions = {}
+    category_names = None
+
+    for file_path in file_paths:
+        results, file_categories = read_tally_file(file_path)
+        if category_names is None:
+            category_names = file_categories
+        elif file_categories != category_names:
+            raise Exception(file_path + ": categories " + str(file_categories)
+                            + " do not match " + str(category_names))
+
+        for question in results:
+            questions.setdefault(question, len(questions))
+        file_counts = np.zeros((len(questions), len(category_names)), dtype=np.int64)
+        for question, question_counts in results.items():
+            file_counts[questions[question]] = question_counts
+        if counts is None:
+            counts = file_counts
+        else:
+            counts = np.vstack([counts, np.zeros((len(questions) - len(counts), len(category_names)), dtype=np.int64)])
+            counts += file_counts
+
+    if counts is None:
+        raise Exception("no tally file to merge")
+    return dict(zip(questions, counts.tolist())), category_names
+
+
+# Draw the Majority Judgment bar chart, returns the matplotlib figure.
+# Without 'fig', a Figure out of pyplot is used, so that charts can be rendered
+# from any thread. Segments and their counts are drawn as collections, not one
+# artist per bar or per count.
+def draw_survey(results, category_names, title, display_major=True, sort_by_rank=False, fig=None):
+    import matplotlib
+    import matplotlib.patches as mpatches
+    from matplotlib.collections import PathCollection, PolyCollection
+    from matplotlib.figure import Figure
+
+    if sort_by_rank:
+        results = {label: results[label] for _, label, _ in majority_ranking(results)}
     labels = list(results.keys())
-    data = np.array(list(results.values()))
+    data = np.array(list(results.values())).reshape(len(labels), -1)
     data_cum = data.cumsum(axis=1)
-    category_colors = plt.get_cmap("Spectral")(np.linspace(0.15, 0.85, data.shape[1]))
+    category_colors = matplotlib.colormaps["Spectral"](np.linspace(0.15, 0.85, data.shape[1]))
 
-    fig, ax = plt.subplots(figsize=(9.2, 5))
-    ax.invert_yaxis()
+    if fig is None:
+        fig = Figure(figsize=(9.2, figure_height(len(labels))))
+    ax = fig.subplots()
     ax.xaxis.set_visible(False)
-    ax.set_xlim(0, np.sum(data, axis=1).max())
-
-    for i, (colname, color) in enumerate(zip(category_names, category_colors)):
-        widths = data[:, i]
-        starts = data_cum[:, i] - widths
-        ax.barh(
-            labels,
-            widths,
-            left=starts,
-            height=0.5,
-            label=colname,
-            color=color,
-            edgecolor="black",
-            linewidth=0.1,
-        )
 
-        xcenters = starts + widths / 2
+    # Every (question, grade) segment, as bars of height 0.5 centered on the question
+    rows = np.arange(len(labels))
+    widths = data.ravel()
+    starts = (data_cum - data).ravel()
+    ys = np.repeat(rows, data.shape[1])
+    colors = np.tile(category_colors, (len(labels), 1))
+    ax.add_collection(PolyCollection(
+        bar_vertices(starts, ys, widths), facecolors=colors, edgecolors="black", linewidths=0.1,
+    ))
+
+    # Counts in the middle of the non-empty segments, one glyphs path per
+    # distinct count, sized in points and placed at the data coordinates
+    shown = widths > 0
+    count_paths = {count: count_label_path(count) for count in np.unique(widths[shown]).tolist()}
+    ax.add_collection(PathCollection(
+        [count_paths[count] for count in widths[shown].tolist()],
+        offsets=np.column_stack([(starts + widths / 2)[shown], ys[shown]]),
+        offset_transform=ax.transData,
+        transform=matplotlib.transforms.Affine2D().scale(1 / 72) + fig.dpi_scale_trans,
+        facecolors="black", edgecolors="none", zorder=3,
+    ), autolim=False)
 
-        for y, (x, c) in enumerate(zip(xcenters, widths)):
-            if c > 0:
-                ax.text(x, y, str(int(c)), ha="center", va="center", color="black")
+    ax.set_yticks(rows, labels)
+    ax.set_ylim(len(labels) - 0.5, -0.5)
+    ax.set_xlim(0, max(np.sum(data, axis=1).max(initial=0), 1))
 
     # Calculate and draw a line in the middle
     if display_major:
@@ -133,9 +1380,7 @@ def survey(results, category_names, title, display_major=True, plot=True):
         medline_linewidth = 1.5
         medline_linestyle = "-"
 
-    for label in results.keys():
-        total_responses = sum(results[label])
-        median_response_count = total_responses / 2
+    for median_response_count in np.unique(np.sum(data, axis=1) / 2):
         ax.axvline(
             x=median_response_count,
             color="black",
@@ -145,13 +1390,16 @@ def survey(results, category_names, title, display_major=True, plot=True):
         )
 
     # Create the legend
-    handles = ax.get_legend_handles_labels()[0]
+    handles = [
+        mpatches.Patch(facecolor=color, edgecolor="black", linewidth=0.1, label=colname)
+        for colname, color in zip(category_names, category_colors)
+    ]
     if display_major:
         major_legend = mpatches.Patch(
             facecolor="none", label="Major", edgecolor="darkgrey", linewidth=2
         )
         handles.append(major_legend)
-    plt.legend(
+    ax.legend(
         handles=handles,
         ncol=len(category_names) + 1,
         bbox_to_anchor=(0.5, -0.025),
@@ -162,39 +1410,296 @@ def survey(results, category_names, title, display_major=True, plot=True):
     )
 
     # Calculate and highlight the winner for each question
-    if display_major:
-        for i, label in enumerate(labels):
-            responses = np.array(results[label])
-            cumulative_responses = np.cumsum(responses)
-            total_responses = cumulative_responses[-1]
-            median_index = np.where(cumulative_responses >= total_responses / 2)[0][0]
-
-            # Highlighting the winning segment with a black border and no fill
-            left_sum = np.sum(responses[:median_index])
-            ax.barh(
-                i,
-                responses[median_index],
-                left=left_sum,
-                height=0.5,
-                color="none",
-                edgecolor="darkgrey",
-                linewidth=5,
-            )
-
-    # Misc and plot
+    if display_major and len(labels):
+        median_index = majority_grades(results)
+        # Highlighting the winning segment with a black border and no fill
+        left_sum = data_cum[rows, median_index] - data[rows, median_index]
+        ax.add_collection(PolyCollection(
+            bar_vertices(left_sum, rows, data[rows, median_index]),
+            facecolors="none", edgecolors="darkgrey", linewidths=5,
+        ))
+
+    # Misc
     ax.set_facecolor("lightgrey")
-    plt.title(title, x=0.5, y=1.05, weight="bold")
+    ax.set_title(title, x=0.5, y=1.05, weight="bold")
+    return fig
+
+
+# Glyphs of a count as a path in points, centered on (0, 0) like a centered text
+def count_label_path(count):
+    import matplotlib
+    from matplotlib.textpath import TextPath
+
+    path = TextPath((0, 0), str(int(count)), size=matplotlib.rcParams["font.size"])
+    extents = path.get_extents()
+    return path.transformed(matplotlib.transforms.Affine2D().translate(
+        -(extents.x0 + extents.x1) / 2, -(extents.y0 + extents.y1) / 2))
 
+
+# Rectangles (x, y - 0.25) -> (x + width, y + 0.25), as PolyCollection vertices
+def bar_vertices(starts, ys, widths, height=0.5):
+    lefts = np.asarray(starts, dtype=float)
+    rights = lefts + np.asarray(widths, dtype=float)
+    bottoms = np.asarray(ys, dtype=float) - height / 2
+    tops = bottoms + height
+    return np.stack([
+        np.stack([lefts, bottoms], axis=-1),
+        np.stack([rights, bottoms], axis=-1),
+        np.stack([rights, tops], axis=-1),
+        np.stack([lefts, tops], axis=-1),
+    ], axis=1)
+
+
+# The chart keeps the original 9.2x5 size, and grows with long pages
+def figure_height(rows_count):
+    return max(5, 2 + 0.3 * rows_count)
+
+
+# Split the results in pages of 'rows_per_page' questions (ranking order kept)
+def survey_pages(results, rows_per_page=ROWS_PER_PAGE, sort_by_rank=False):
+    if sort_by_rank:
+        results = {label: results[label] for _, label, _ in majority_ranking(results)}
+    labels = list(results.keys())
+    if not rows_per_page or len(labels) <= rows_per_page:
+        return [results]
+    return [
+        {label: results[label] for label in labels[i:i + rows_per_page]}
+        for i in range(0, len(labels), rows_per_page)
+    ]
+
+
+def page_title(title, page, pages_count):
+    if pages_count == 1:
+        return title
+    return "%s (%d/%d)" % (title, page + 1, pages_count)
+
+
+# Hash of everything that changes a rendered chart
+def render_cache_key(results, category_names, title, **options):
+    payload = json.dumps(
+        [list(results.items()), list(category_names), title, sorted(options.items())],
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def render_cache_get(key):
+    images = RENDER_CACHE.get(key)
+    if images is not None:
+        RENDER_CACHE.move_to_end(key)
+    return images
+
+
+def render_cache_put(key, images):
+    global RENDER_CACHE_BYTES
+    if key in RENDER_CACHE:
+        return
+    RENDER_CACHE[key] = images
+    RENDER_CACHE_BYTES += sum(len(image) for image in images)
+    # Evict the least recently used charts
+    while RENDER_CACHE_BYTES > RENDER_CACHE_MAX_BYTES and len(RENDER_CACHE) > 1:
+        _, evicted = RENDER_CACHE.popitem(last=False)
+        RENDER_CACHE_BYTES -= sum(len(image) for image in evicted)
+
+
+def survey_cache_key(results, category_names, title, display_major=True, sort_by_rank=False,
+                     dpi=300, fmt="png", rows_per_page=ROWS_PER_PAGE):
+    return render_cache_key(results, category_names, title,
+                            display_major=display_major, sort_by_rank=sort_by_rank,
+                            dpi=dpi, fmt=fmt, rows_per_page=rows_per_page)
+
+
+# On-disk charts cache, shared by the CLI runs: one file per page, named after
+# the render cache key, the least recently used files are removed beyond
+# RENDER_DISK_CACHE_MAX_BYTES
+RENDER_DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def default_render_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "majority-judgment")
+
+
+# Page files: <key>-<page>-<pages count>.<fmt>
+def render_disk_cache_get(cache_dir, key):
+    files = glob.glob(os.path.join(cache_dir, key + "-*-*.*"))
+    if not files:
+        return None
+    pages = {}
+    for file in files:
+        # A page still being written by another run
+        if file.endswith(".tmp"):
+            continue
+        page, count = os.path.basename(file)[len(key) + 1:].split(".")[0].split("-")
+        pages[int(page)] = (int(count), file)
+    counts = {count for count, _ in pages.values()}
+    if len(counts) != 1 or sorted(pages) != list(range(counts.pop())):
+        return None
+    images = []
+    try:
+        for page in sorted(pages):
+            with open(pages[page][1], "rb") as file:
+                images.append(file.read())
+            os.utime(pages[page][1])
+    except OSError:
+        return None
+    return tuple(images)
+
+
+def render_disk_cache_put(cache_dir, key, images, fmt):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for page, image in enumerate(images):
+            path = os.path.join(cache_dir, "%s-%d-%d.%s" % (key, page, len(images), fmt))
+            # One temporary file per process, concurrent runs may write the same page
+            temporary_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(temporary_path, "wb") as file:
+                file.write(image)
+            os.replace(temporary_path, path)
+
+        # Evict the least recently used files
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= RENDER_DISK_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+    except OSError:
+        # The cache is an optimization, the chart is still returned
+        pass
+
+
+# Render the chart as a list of images bytes ('fmt': png, svg, pdf...), one per
+# page of 'rows_per_page' questions. Charts already rendered with the same
+# tallies, categories, title and options are returned from the cache, and from
+# the on-disk cache of 'cache_dir' when given.
+def render_survey(results, category_names, title, display_major=True, sort_by_rank=False, use_cache=True,
+                  dpi=300, fmt="png", rows_per_page=ROWS_PER_PAGE, cache_dir=None):
+    key = survey_cache_key(results, category_names, title, display_major, sort_by_rank,
+                           dpi, fmt, rows_per_page)
+    images = render_cache_get(key) if use_cache else None
+    if images is None and cache_dir is not None:
+        images = render_disk_cache_get(cache_dir, key)
+        if images is not None and use_cache:
+            render_cache_put(key, images)
+    if images is None:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        pages = survey_pages(results, rows_per_page, sort_by_rank)
+        images = []
+        for page, page_results in enumerate(pages):
+            with profile_stage("draw"):
+                fig = draw_survey(page_results, category_names, page_title(title, page, len(pages)),
+                                  display_major)
+            # Non-interactive Agg canvas, the figure is released with the buffer
+            with profile_stage("save"):
+                FigureCanvasAgg(fig)
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format=fmt, dpi=dpi)
+                images.append(buffer.getvalue())
+        images = tuple(images)
+        if use_cache:
+            render_cache_put(key, images)
+        if cache_dir is not None:
+            render_disk_cache_put(cache_dir, key, images, fmt)
+    return images
+
+
+def chart_file_name(title, fmt="png", page=0, pages_count=1):
+    if title == "":
+        name = "plot"
+    else:
+        # Remove special chars for Windows files
+        name = re.sub(r'\W', '_', title)
+    if pages_count > 1:
+        name += "_" + str(page + 1)
+    return name + "." + fmt
+
+
+def survey(results, category_names, title, display_major=True, plot=True, sort_by_rank=False,
+           dpi=300, fmt="png", rows_per_page=ROWS_PER_PAGE, cache_dir=None):
     if plot:
+        import matplotlib.pyplot as plt
+
+        pages = survey_pages(results, rows_per_page, sort_by_rank)
+        figures = []
+        for page, page_results in enumerate(pages):
+            with profile_stage("draw"):
+                fig = plt.figure(figsize=(9.2, figure_height(len(page_results))))
+                draw_survey(page_results, category_names, page_title(title, page, len(pages)),
+                            display_major, fig=fig)
+            figures.append(fig)
         plt.show()
+        for fig in figures:
+            plt.close(fig)
     else:
-        if title == "":
-            png_name = "plot.png"
-        else:
-            # Remove special chars for Windows files
-            png_name = re.sub(r'\W', '_', title) + ".png"
-        # Save the figure as a PNG file
-        plt.savefig(png_name, dpi=300)
+        # Save the figure(s) as image files
+        images = render_survey(results, category_names, title, display_major, sort_by_rank,
+                               dpi=dpi, fmt=fmt, rows_per_page=rows_per_page, cache_dir=cache_dir)
+        with profile_stage("write"):
+            for page, image in enumerate(images):
+                with open(chart_file_name(title, fmt, page, len(images)), "wb") as image_file:
+                    image_file.write(image)
+
+
+# CSV files of a batch: every *.csv of a directory, or the files matching a glob
+def list_survey_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.csv")))
+    return sorted(glob.glob(path))
+
+
+# Aggregate and render one survey of a batch, run in a worker process.
+# Errors are returned in the summary instead of aborting the batch.
+# Charts are titled after 'title', or after the file name when empty.
+def process_survey_file(file_path, category_names, ignore_first_column=False, values_type="int",
+                        chunksize=None, title="", display_major=True, sort_by_rank=False,
+                        dpi=300, fmt="png", rows_per_page=ROWS_PER_PAGE, output_dir=".", ignore_columns=()):
+    try:
+        results = read_and_aggregate_csv(file_path, category_names, ignore_first_column, values_type,
+                                         chunksize=chunksize, ignore_columns=ignore_columns)
+        title = title or os.path.splitext(os.path.basename(file_path))[0]
+        images = render_survey(results, category_names, title, display_major, sort_by_rank,
+                               use_cache=False, dpi=dpi, fmt=fmt, rows_per_page=rows_per_page)
+        charts = []
+        for page, image in enumerate(images):
+            chart = os.path.join(output_dir, chart_file_name(title, fmt, page, len(images)))
+            with open(chart, "wb") as image_file:
+                image_file.write(image)
+            charts.append(chart)
+        return {
+            "file": file_path,
+            "status": "ok",
+            "charts": charts,
+            "results": results,
+            "ranking": ranking_records(results, category_names),
+        }
+    except Exception as error:
+        return {"file": file_path, "status": "error", "error": "%s: %s" % (type(error).__name__, error)}
+
+
+# Process many surveys over a pool of 'jobs' processes (default: one per core),
+# returns the summaries in the order of 'files'
+def run_batch(files, category_names, jobs=None, **options):
+    summaries = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {
+            pool.submit(process_survey_file, file_path, category_names, **options): file_path
+            for file_path in files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            if summary["status"] == "ok":
+                print("OK     %s" % summary["file"], file=sys.stderr)
+            else:
+                print("ERROR  %s: %s" % (summary["file"], summary["error"]), file=sys.stderr)
+    return [summaries[file_path] for file_path in files]
 
 
 if __name__ == "__main__":
@@ -214,21 +1719,35 @@ Examples of usages:
     ./majority_judgment.py -c resto.csv
     ./majority_judgment.py -c resto.csv -l fr -t 'Restaurants'
     ./majority_judgment.py -c resto.csv -C 'Too bad' 'Bad' 'Okay' 'Good' 'Very good'
-    ./majority_judgment.py -c tier-list.csv -C B- B+ A- A+ S SS -T str -t 'Tier List'""",
+    ./majority_judgment.py -c tier-list.csv -C B- B+ A- A+ S SS -T str -t 'Tier List'
+    ./majority_judgment.py -B exports/ -I --output-dir charts/""",
         formatter_class=RawTextHelpFormatter,
     )
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         "-c",
         "--csv",
-        required=True,
         help="Path to the CSV file containing survey data.",
     )
+    source.add_argument(
+        "-B",
+        "--batch",
+        help="""Process every CSV file of a directory (or matching a glob) in parallel,
+write one chart per survey and a batch_summary.json file.""",
+    )
+    source.add_argument(
+        "-M",
+        "--tallies",
+        nargs="+",
+        help="""Read (and merge) tally files instead of raw ballots, the
+categories are read from the files.""",
+    )
     parser.add_argument(
         "-p",
         "--png",
         action='store_true',
         default=False,
-        help="Write a PNG file instead of plotting results.",
+        help="Write a PNG file (see --format) instead of plotting results.",
     )
     parser.add_argument("-t", "--title", default="", help="Title of the chart.")
     parser.add_argument(
@@ -258,6 +1777,157 @@ Examples of usages:
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        "-R",
+        "--rank",
+        help="""Print the majority judgment ranking.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "-S",
+        "--sort",
+        help="""Order the bars by ranking.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        choices=["json", "csv"],
+        help="""Print the tallies and the ranking instead of drawing a chart.""",
+    )
+    parser.add_argument(
+        "--robustness",
+        type=int,
+        metavar="SAMPLES",
+        help="""Print the probability of each majority grade and rank position of
+every question, over SAMPLES resampled tallies (in the JSON output with -o json,
+not supported by -o csv).""",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="""Random seed of --robustness.""",
+    )
+    parser.add_argument(
+        "-g",
+        "--segment",
+        nargs="+",
+        metavar="COLUMN",
+        help="""Tally the CSV of -c by segment, every distinct value (or combination of
+values) of the COLUMN(s), read once: one ranking, chart or output per segment.""",
+    )
+    parser.add_argument(
+        "--time-column",
+        metavar="COLUMN",
+        help="""Time of each ballot of the CSV of -c (dates, UTC unless stated, or
+seconds), it is not a question. Enables --since, --until and --time-series.""",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="TIME",
+        help="""Only count the ballots from TIME (ex: "2024-03-01" or "2024-03-01 18:00").""",
+    )
+    parser.add_argument(
+        "--until",
+        metavar="TIME",
+        help="""Only count the ballots before TIME, i.e. the results as of TIME.""",
+    )
+    parser.add_argument(
+        "--time-series",
+        metavar="INTERVAL",
+        help="""Print the majority grade of every question at the end of each period
+of INTERVAL (ex: "1D", "6h" or seconds), as CSV or as JSON with -o json.""",
+    )
+    parser.add_argument(
+        "--write-tallies",
+        help="""Write the tallies to a tally file instead of drawing a chart.""",
+    )
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=300,
+        help="""Resolution of the written chart. (default: 300)""",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        default="png",
+        choices=["png", "svg", "pdf"],
+        help='Format of the written chart. (default: "png")',
+    )
+    parser.add_argument(
+        "--rows-per-page",
+        type=int,
+        default=ROWS_PER_PAGE,
+        help="""Split charts with more questions into several pages. (default: %d)""" % ROWS_PER_PAGE,
+    )
+    parser.add_argument(
+        "--render-cache",
+        metavar="DIR",
+        default=default_render_cache_dir(),
+        help="""Directory of the written charts cache, an unchanged chart is copied
+from it instead of being drawn again. (default: "%s")""" % default_render_cache_dir(),
+    )
+    parser.add_argument(
+        "--no-render-cache",
+        help="""Do not read nor write the charts cache.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--profile",
+        help="""Print the time and peak memory of each stage on stderr.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="""Number of worker processes of --batch (default: number of cores),
+or tally the CSV of -c by shards over JOBS processes.""",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=".",
+        help="""Directory of the charts and summary written by --batch. (default: ".")""",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="""Stream the CSV by chunks of CHUNKSIZE rows (constant memory).""",
+    )
+    parser.add_argument(
+        "--cache",
+        help="""Tally the CSV of -c from its binary ballot cache (CSV_FILE.mjc),
+written at the first run and again whenever the CSV changes.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--watch",
+        help="""Keep reading the rows appended to the CSV of -c, and write the chart
+files (or print the -o output) again when the tallies change. Stop with Ctrl+C.""",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=1.0,
+        help="""Seconds between two reads of the watched CSV. (default: 1)""",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        help="""Seconds to wait for more changes before writing the chart again. (default: 2)""",
+    )
     parser.add_argument(
         "-I",
         "--ignore-first-column",
@@ -265,6 +1935,14 @@ Examples of usages:
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        "-X",
+        "--ignore-columns",
+        nargs="+",
+        metavar="COLUMN",
+        default=[],
+        help="""Ignores the COLUMN(s) of the csv data, that are not questions (ex: timestamp, email).""",
+    )
 
     args = parser.parse_args()
 
@@ -293,5 +1971,172 @@ Examples of usages:
     else:
         plot = True
 
-    results = read_and_aggregate_csv(args.csv, category_names, args.ignore_first_column, args.type)
-    survey(results, category_names, args.title, not args.disable_major, plot)
\ No newline at end of file
+    render_cache_dir = None if args.no_render_cache else args.render_cache
+
+    if args.profile:
+        profile = StageProfile()
+        enable_profiling(profile)
+        atexit.register(lambda: print(profile.report(), file=sys.stderr))
+
+    if args.batch is not None:
+        files = list_survey_files(args.batch)
+        if not files:
+            parser.error("no CSV file found for --batch " + args.batch)
+        os.makedirs(args.output_dir, exist_ok=True)
+        summaries = run_batch(
+            files, category_names, args.jobs,
+            ignore_first_column=args.ignore_first_column, values_type=args.type,
+            chunksize=args.chunksize, title=args.title, display_major=not args.disable_major,
+            sort_by_rank=args.sort, dpi=args.dpi, fmt=args.format,
+            rows_per_page=args.rows_per_page, output_dir=args.output_dir, ignore_columns=args.ignore_columns,
+        )
+        summary_file = os.path.join(args.output_dir, "batch_summary.json")
+        with open(summary_file, "w", encoding="utf-8") as file:
+            json.dump(summaries, file, ensure_ascii=False, indent=2)
+        failures = sum(summary["status"] != "ok" for summary in summaries)
+        print("%d survey(s) processed, %d failure(s), summary: %s"
+              % (len(summaries), failures, summary_file), file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+    if args.watch:
+        if args.csv is None:
+            parser.error("--watch needs a CSV file (-c)")
+        if args.segment is not None or args.time_column is not None or args.cache or args.jobs is not None:
+            parser.error("--watch does not support --segment, --time-column, --cache nor --jobs")
+        if args.write_tallies is not None or args.robustness is not None:
+            parser.error("--watch does not support --write-tallies nor --robustness")
+
+        def on_change(results):
+            if args.output == "json":
+                write_results_json(results, category_names)
+            elif args.output == "csv":
+                write_results_csv(results, category_names)
+            else:
+                if args.rank:
+                    print_ranking(majority_ranking(results), category_names)
+                survey(results, category_names, args.title, not args.disable_major, False, args.sort,
+                       dpi=args.dpi, fmt=args.format, rows_per_page=args.rows_per_page,
+                       cache_dir=render_cache_dir)
+                print("Chart written (%d voter(s))" % max([sum(counts) for counts in results.values()], default=0))
+            sys.stdout.flush()
+
+        try:
+            watch_csv(args.csv, category_names, on_change, args.ignore_first_column, args.type,
+                      interval=args.watch_interval, debounce=args.debounce, ignore_columns=args.ignore_columns)
+        except Exception as e:
+            parser.error(str(e))
+        sys.exit(0)
+
+    if args.segment is not None:
+        if args.csv is None:
+            parser.error("--segment needs a CSV file (-c)")
+        if args.write_tallies is not None or args.robustness is not None:
+            parser.error("--segment does not support --write-tallies nor --robustness")
+        if args.time_column is not None:
+            parser.error("--segment does not support --time-column")
+        try:
+            segments = read_and_aggregate_segments(args.csv, category_names, args.segment, args.ignore_first_column,
+                                                   args.type, chunksize=args.chunksize,
+                                                   ignore_columns=args.ignore_columns)
+        except Exception as e:
+            parser.error(str(e))
+        if args.output == "json":
+            write_segments_json(segments, args.segment, category_names)
+        elif args.output == "csv":
+            write_segments_csv(segments, args.segment, category_names)
+        else:
+            # Small multiples: the charts of every segment, with the same questions and categories
+            for segment, results in segments.items():
+                label = segment_label(args.segment, segment)
+                if args.rank:
+                    print(label)
+                    print_ranking(majority_ranking(results), category_names)
+                title = "%s (%s)" % (args.title, label) if args.title else label
+                survey(results, category_names, title, not args.disable_major, plot, args.sort,
+                       dpi=args.dpi, fmt=args.format, rows_per_page=args.rows_per_page,
+                       cache_dir=render_cache_dir)
+        sys.exit(0)
+
+    if args.robustness is not None and (args.output == "csv" or args.write_tallies is not None
+                                        or args.time_series is not None):
+        parser.error("--robustness is printed with the chart or in the -o json output, "
+                     "it does not support -o csv, --write-tallies nor --time-series")
+
+    if args.time_column is None and (args.since or args.until or args.time_series):
+        parser.error("--since, --until and --time-series need a time column (--time-column)")
+
+    if args.time_column is not None:
+        if args.csv is None:
+            parser.error("--time-column needs a CSV file (-c)")
+        since, until = None, None
+        try:
+            if args.since is not None:
+                since = parse_times([args.since])[0]
+            if args.until is not None:
+                until = parse_times([args.until])[0]
+        except Exception:
+            parser.error("--since and --until must be dates or seconds")
+        try:
+            timeline = read_timeline_csv(args.csv, args.time_column, category_names, args.ignore_first_column,
+                                         args.type, chunksize=args.chunksize, ignore_columns=args.ignore_columns)
+        except Exception as e:
+            parser.error(str(e))
+        if args.time_series is not None:
+            import pandas as pd
+
+            try:
+                interval = float(args.time_series)
+            except ValueError:
+                interval = pd.Timedelta(args.time_series).total_seconds()
+            times = timeline.periods(interval)
+            times = times[(times > (since if since is not None else -np.inf))
+                          & (times <= (until if until is not None else np.inf))]
+            if args.output == "json":
+                write_time_series_json(timeline, times, since)
+            else:
+                write_time_series_csv(timeline, times, since)
+            sys.exit(0)
+        results = timeline.results(since, until)
+    elif args.tallies is not None:
+        try:
+            results, category_names = merge_tally_files(args.tallies)
+        except Exception as e:
+            parser.error(str(e))
+        if args.categories is not None and [str(name) for name in args.categories] != category_names:
+            parser.error("--categories do not match the categories of the tally files")
+    else:
+        try:
+            if args.cache:
+                results = cached_read_and_aggregate_csv(args.csv, category_names, args.ignore_first_column, args.type,
+                                                        chunksize=args.chunksize, ignore_columns=args.ignore_columns)
+            elif args.jobs is not None and args.jobs > 1:
+                results = parallel_read_and_aggregate_csv(args.csv, category_names, args.ignore_first_column,
+                                                          args.type, chunksize=args.chunksize, jobs=args.jobs,
+                                                          ignore_columns=args.ignore_columns)
+            else:
+                results = read_and_aggregate_csv(args.csv, category_names, args.ignore_first_column, args.type,
+                                                 chunksize=args.chunksize, ignore_columns=args.ignore_columns)
+        except Exception as e:
+            parser.error(str(e))
+
+    if args.write_tallies is not None:
+        write_tally_file(results, category_names, args.write_tallies)
+        sys.exit(0)
+    stability = None
+    if args.robustness is not None:
+        stability = robustness(results, args.robustness, args.seed)
+
+    if args.output == "json":
+        write_results_json(results, category_names, robustness=stability)
+        sys.exit(0)
+    elif args.output == "csv":
+        write_results_csv(results, category_names)
+        sys.exit(0)
+
+    if args.rank:
+        print_ranking(majority_ranking(results), category_names)
+    if stability is not None:
+        print_robustness(stability, category_names, majority_ranking(results))
+    survey(results, category_names, args.title, not args.disable_major, plot, args.sort,
+           dpi=args.dpi, fmt=args.format, rows_per_page=args.rows_per_page,
+           cache_dir=render_cache_dir)
\ No newline at end of file
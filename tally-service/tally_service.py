@@ -0,0 +1,393 @@
+#!/bin/env python3
+
+"""
+Majority Judgment tally service: collect ballots over HTTP, serve live tallies, rankings and charts
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import time
+import urllib.parse
+import uuid
+
+# Add the parent directory to the Python path, to get majority_judgment.py
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+import numpy as np
+import majority_judgment as mj
+
+# Larger request bodies are refused (413)
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Poll:
+
+    # 'categories': grade names (ascending order), ballots grade questions with these names
+    def __init__(self, title, questions, categories, poll_id=None):
+        if not isinstance(questions, list) or not isinstance(categories, list):
+            raise HTTPError("400 Bad Request", "questions and categories must be lists")
+        if not questions or not categories:
+            raise HTTPError("400 Bad Request", "a poll needs questions and categories")
+        if len(set(questions)) != len(questions):
+            raise HTTPError("400 Bad Request", "questions must be unique")
+        self.poll_id = poll_id or uuid.uuid4().hex[:12]
+        self.title = title
+        self.questions = [str(question) for question in questions]
+        self.categories = [str(name) for name in categories]
+        self.lookup = {name: code for code, name in enumerate(self.categories)}
+        self.question_index = {question: i for i, question in enumerate(self.questions)}
+
+        # Running tallies: (questions x categories)
+        self.counts = np.zeros((len(self.questions), len(self.categories)), dtype=np.int64)
+        self.voters = 0
+        self.invalid = 0
+        # Ballots accepted but not tallied yet, as lists of grades in the questions order
+        self.pending = []
+        # Incremented by every tally change, to know when to snapshot
+        self.version = 0
+
+    # Grades of a ballot in the questions order, from a list in this order or
+    # from a dict {"question": "grade"} (missing questions are not graded)
+    def ballot_grades(self, ballot):
+        if isinstance(ballot, dict):
+            grades = [None] * len(self.questions)
+            for question, grade in ballot.items():
+                index = self.question_index.get(question)
+                if index is None:
+                    raise HTTPError("400 Bad Request", "unknown question '%s'" % question)
+                grades[index] = grade
+            return grades
+        if isinstance(ballot, list) and len(ballot) == len(self.questions):
+            return ballot
+        raise HTTPError("400 Bad Request", "a ballot is a dict or a list of %d grades" % len(self.questions))
+
+    # Validate the ballots and queue them for the next tally
+    def submit(self, ballots):
+        if not isinstance(ballots, list):
+            raise HTTPError("400 Bad Request", "'ballots' must be a list")
+        grades = [self.ballot_grades(ballot) for ballot in ballots]
+        self.pending.extend(grades)
+        return len(grades)
+
+    # Tally every pending ballot at once
+    def flush(self):
+        if not self.pending:
+            return
+        ballots, self.pending = self.pending, []
+        lookup = self.lookup
+        cells = len(ballots) * len(self.questions)
+        codes = np.fromiter(
+            (-1 if grade is None else lookup.get(str(grade), -1) for ballot in ballots for grade in ballot),
+            dtype=np.int64, count=cells,
+        ).reshape(len(ballots), len(self.questions))
+        self.counts += mj.tally_grade_codes(codes, len(self.categories))
+        # Not graded questions are not invalid
+        self.invalid += int((codes < 0).sum()) - sum(ballot.count(None) for ballot in ballots)
+        self.voters += len(ballots)
+        self.version += 1
+
+    def results(self):
+        self.flush()
+        return dict(zip(self.questions, self.counts.tolist()))
+
+    def summary(self):
+        self.flush()
+        return {
+            "poll_id": self.poll_id,
+            "title": self.title,
+            "questions": self.questions,
+            "categories": self.categories,
+            "voters": self.voters,
+            "invalid": self.invalid,
+            "results": dict(zip(self.questions, self.counts.tolist())),
+        }
+
+    def snapshot(self):
+        self.flush()
+        return {
+            "poll_id": self.poll_id,
+            "title": self.title,
+            "questions": self.questions,
+            "categories": self.categories,
+            "voters": self.voters,
+            "invalid": self.invalid,
+            "counts": self.counts.tolist(),
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        poll = cls(snapshot["title"], snapshot["questions"], snapshot["categories"], snapshot["poll_id"])
+        poll.counts[:] = snapshot["counts"]
+        poll.voters = snapshot["voters"]
+        poll.invalid = snapshot["invalid"]
+        return poll
+
+
+class TallyService:
+
+    # 'snapshot_path': JSON file of the polls, None to keep them only in memory
+    # 'batch_interval': seconds between two tallies of the pending ballots
+    # 'snapshot_interval': seconds between two snapshots (only written when polls changed)
+    def __init__(self, snapshot_path=None, batch_interval=0.05, snapshot_interval=5.0, render_workers=2):
+        self.snapshot_path = snapshot_path
+        self.batch_interval = batch_interval
+        self.snapshot_interval = snapshot_interval
+        # {poll_id: Poll}
+        self.polls = {}
+        self.snapshot_versions = None
+        # Charts are rendered out of the event loop, a chart being rendered is shared:
+        #   {cache key: asyncio.Future}
+        self.render_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=render_workers, thread_name_prefix="render")
+        self.render_jobs = {}
+        self.routes = [
+            ("GET", re.compile(r"^/polls$"), self.list_polls),
+            ("POST", re.compile(r"^/polls$"), self.create_poll),
+            ("GET", re.compile(r"^/polls/(\w+)$"), self.get_poll),
+            ("DELETE", re.compile(r"^/polls/(\w+)$"), self.delete_poll),
+            ("POST", re.compile(r"^/polls/(\w+)/ballots$"), self.submit_ballots),
+            ("GET", re.compile(r"^/polls/(\w+)/ranking$"), self.get_ranking),
+            ("GET", re.compile(r"^/polls/(\w+)/chart$"), self.get_chart),
+        ]
+
+    def load(self):
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, encoding="utf-8") as file:
+            snapshots = json.load(file)["polls"]
+        for snapshot in snapshots:
+            poll = Poll.from_snapshot(snapshot)
+            self.polls[poll.poll_id] = poll
+        self.snapshot_versions = self.versions()
+        logging.info("%d poll(s) restored from %s", len(self.polls), self.snapshot_path)
+
+    def versions(self):
+        return {poll_id: poll.version for poll_id, poll in self.polls.items()}
+
+    # Write the polls to 'snapshot_path' (atomically), when they changed
+    def save(self):
+        if self.snapshot_path is None:
+            return
+        snapshots = [poll.snapshot() for poll in self.polls.values()]
+        versions = self.versions()
+        if versions == self.snapshot_versions:
+            return
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump({"polls": snapshots}, file, ensure_ascii=False)
+        os.replace(temporary_path, self.snapshot_path)
+        self.snapshot_versions = versions
+
+    def get(self, poll_id):
+        poll = self.polls.get(poll_id)
+        if poll is None:
+            raise HTTPError("404 Not Found", "unknown poll '%s'" % poll_id)
+        return poll
+
+    async def list_polls(self, query, body):
+        return [
+            {"poll_id": poll.poll_id, "title": poll.title, "voters": poll.voters + len(poll.pending)}
+            for poll in self.polls.values()
+        ]
+
+    # {"title": "...", "questions": ["Q1", ...], "categories": ["Bad", ..., "Good"]}
+    async def create_poll(self, query, body):
+        if not isinstance(body, dict):
+            raise HTTPError("400 Bad Request", "a JSON object is expected")
+        poll = Poll(body.get("title", ""), body.get("questions") or [], body.get("categories") or [])
+        self.polls[poll.poll_id] = poll
+        logging.info("Poll %s created: '%s'", poll.poll_id, poll.title)
+        return poll.summary()
+
+    async def get_poll(self, query, body, poll_id):
+        return self.get(poll_id).summary()
+
+    async def delete_poll(self, query, body, poll_id):
+        poll = self.polls.pop(self.get(poll_id).poll_id)
+        logging.info("Poll %s deleted: '%s'", poll.poll_id, poll.title)
+        return {"poll_id": poll.poll_id}
+
+    # {"ballots": [{"Q1": "Good", ...}, ["Bad", ...], ...]}, tallied with the next batch
+    async def submit_ballots(self, query, body, poll_id):
+        poll = self.get(poll_id)
+        if not isinstance(body, dict):
+            raise HTTPError("400 Bad Request", "a JSON object is expected")
+        return {"accepted": poll.submit(body.get("ballots"))}
+
+    async def get_ranking(self, query, body, poll_id):
+        poll = self.get(poll_id)
+        return mj.ranking_records(poll.results(), poll.categories)
+
+    # PNG chart of a poll, ?page=N for polls split into several pages
+    async def get_chart(self, query, body, poll_id):
+        poll = self.get(poll_id)
+        results = poll.results()
+        if not poll.voters:
+            raise HTTPError("404 Not Found", "no ballot to draw yet")
+        key = mj.survey_cache_key(results, poll.categories, poll.title)
+
+        # Cache is only used from the event loop
+        images = mj.render_cache_get(key)
+        if images is None:
+            job = self.render_jobs.get(key)
+            if job is None:
+                job = asyncio.ensure_future(self.render(key, results, poll))
+                self.render_jobs[key] = job
+                job.add_done_callback(lambda _: self.render_jobs.pop(key, None))
+            images = await asyncio.shield(job)
+
+        try:
+            page = int(query.get("page", ["0"])[0])
+            return "image/png", images[page]
+        except (ValueError, IndexError):
+            raise HTTPError("404 Not Found", "the chart has %d page(s)" % len(images))
+
+    async def render(self, key, results, poll):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        images = await loop.run_in_executor(
+            self.render_pool, lambda: mj.render_survey(results, poll.categories, poll.title, use_cache=False))
+        mj.render_cache_put(key, images)
+        logging.info("'%s' rendered in %.3fs (%d page(s))", poll.title, time.perf_counter() - start, len(images))
+        return images
+
+    # Route a request, returns (status, content type, body bytes)
+    async def dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        path_matched = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(url.path)
+            if match is None:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            try:
+                document = json.loads(body) if body else None
+            except ValueError:
+                raise HTTPError("400 Bad Request", "invalid JSON body")
+            result = await handler(query, document, *match.groups())
+            if isinstance(result, tuple):
+                return "200 OK", result[0], result[1]
+            return "200 OK", "application/json", json.dumps(result, ensure_ascii=False).encode("utf-8")
+        if path_matched:
+            raise HTTPError("405 Method Not Allowed", "method not allowed")
+        raise HTTPError("404 Not Found", "not found")
+
+    # HTTP/1.1 connection, kept alive between requests
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                length = headers.get("content-length", "0") or "0"
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    if len(parts) < 2:
+                        raise HTTPError("400 Bad Request", "invalid request line")
+                    if not re.fullmatch(r"[0-9]+", length):
+                        # The body cannot be skipped
+                        keep_alive = False
+                        raise HTTPError("400 Bad Request", "invalid Content-Length")
+                    length = int(length)
+                    if length > MAX_BODY_BYTES:
+                        keep_alive = False
+                        raise HTTPError("413 Payload Too Large", "body larger than %d bytes" % MAX_BODY_BYTES)
+                    body = await reader.readexactly(length) if length else b""
+                    status, content_type, payload = await self.dispatch(parts[0], parts[1], body)
+                except HTTPError as error:
+                    status, content_type = error.status, "application/json"
+                    payload = json.dumps({"error": str(error)}).encode("utf-8")
+                except Exception:
+                    logging.exception("Request %s failed", request_line)
+                    status, content_type = "500 Internal Server Error", "application/json"
+                    payload = json.dumps({"error": "internal error"}).encode("utf-8")
+
+                writer.write(("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n"
+                              % (status, content_type, len(payload), "keep-alive" if keep_alive else "close")
+                              ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Tally the pending ballots of every poll every 'batch_interval' seconds
+    async def run_batches(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            for poll in list(self.polls.values()):
+                poll.flush()
+
+    async def run_snapshots(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.save()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info("Tally service listening on http://%s:%d", host, port)
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.run_batches(), self.run_snapshots())
+        finally:
+            self.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+Collect Majority Judgment ballots over HTTP and serve live tallies, rankings and charts.
+
+Examples of usages:
+    ./tally_service.py
+    ./tally_service.py --port 9000 --snapshot polls.json""",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help='Listening address. (default: "127.0.0.1")')
+    parser.add_argument("--port", type=int, default=8080, help="Listening port. (default: 8080)")
+    parser.add_argument("--snapshot", help="JSON file where the polls are saved, and restored from at startup.")
+    parser.add_argument("--snapshot-interval", type=float, default=5.0,
+                        help="Seconds between two snapshots. (default: 5)")
+    parser.add_argument("--batch-interval", type=float, default=0.05,
+                        help="Seconds between two tallies of the submitted ballots. (default: 0.05)")
+    parser.add_argument("--render-workers", type=int, default=2,
+                        help="Threads rendering the charts. (default: 2)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    service = TallyService(args.snapshot, args.batch_interval, args.snapshot_interval, args.render_workers)
+    service.load()
+    # Stop as on Ctrl+C (docker stop), the polls are saved on the way out
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except (KeyboardInterrupt, SystemExit):
+        pass
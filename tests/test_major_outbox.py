@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discord-bot"))
+import major_outbox
+
+
+# Fake time: sleeping only moves the clock forward
+class FakeTime:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+def make_outbox(**options):
+    fake_time = FakeTime()
+    return major_outbox.Outbox(clock=fake_time.clock, sleep=fake_time.sleep, **options), fake_time
+
+
+def test_newer_edit_replaces_waiting_edit():
+    async def main():
+        outbox, _ = make_outbox()
+        sent = []
+
+        async def send(text):
+            sent.append(text)
+
+        outbox.edit("ballot", lambda: send("first"))
+        outbox.edit("other", lambda: send("other"))
+        outbox.edit("ballot", lambda: send("second"))
+        await outbox.drain()
+        # The newer edit keeps the place of the replaced one
+        assert sent == ["second", "other"]
+        assert outbox.stats["coalesced"] == 1
+        assert outbox.stats["sent"] == 2
+
+    asyncio.run(main())
+
+
+def test_same_key_never_sent_twice_at_once():
+    async def main():
+        outbox, _ = make_outbox()
+        running = set()
+        sent = []
+        release = asyncio.Event()
+
+        async def send(text):
+            assert "ballot" not in running
+            running.add("ballot")
+            await release.wait()
+            running.discard("ballot")
+            sent.append(text)
+
+        task = asyncio.ensure_future(outbox.run_calls())
+        outbox.edit("ballot", lambda: send("first"))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert outbox.in_flight == {"ballot"}
+        # Waits for the first edit to be sent
+        outbox.edit("ballot", lambda: send("second"))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert list(outbox.pending) == ["ballot"]
+        release.set()
+        await outbox.drain()
+        task.cancel()
+        assert sent == ["first", "second"]
+
+    asyncio.run(main())
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__("rate limited")
+        self.retry_after = retry_after
+
+
+def test_rate_limited_call_is_sent_again():
+    async def main():
+        outbox, fake_time = make_outbox()
+        attempts = []
+
+        async def send():
+            attempts.append(fake_time.now)
+            if len(attempts) == 1:
+                raise RateLimited(1.5)
+
+        outbox.edit("ballot", send)
+        await outbox.drain()
+        assert attempts == [0.0, 1.5]
+        assert outbox.stats["sent"] == 1
+        assert outbox.stats["failed"] == 0
+
+    asyncio.run(main())
+
+
+def test_announcements_grouped_by_channel():
+    async def main():
+        outbox, _ = make_outbox()
+        summaries = []
+
+        def sender(channel):
+            async def send(names):
+                summaries.append((channel, list(names)))
+            return send
+
+        outbox.announce("general", sender("general"), "alice")
+        outbox.announce("polls", sender("polls"), "bob")
+        outbox.announce("general", sender("general"), "carol")
+        await outbox.drain()
+        assert sorted(summaries) == [("general", ["alice", "carol"]), ("polls", ["bob"])]
+        assert outbox.stats["announced"] == 3
+        assert outbox.stats["sent"] == 2
+
+    asyncio.run(main())
+
+
+def test_rate_limiter_budget():
+    fake_time = FakeTime()
+    limiter = major_outbox.RateLimiter(2, per=1.0, clock=fake_time.clock)
+    assert limiter.take() == 0.0
+    assert limiter.take() == 0.0
+    assert limiter.take() == 0.5
+    fake_time.now += 0.5
+    assert limiter.take() == 0.0
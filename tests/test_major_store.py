@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discord-bot"))
+import pytest
+import major_polls as mjp
+import major_store
+
+
+@pytest.fixture
+def polls_state():
+    listeners = list(mjp.LISTENERS)
+    yield
+    mjp.POLLS.clear()
+    mjp.CHANNEL_POLLS.clear()
+    mjp.TIMELINES.clear()
+    mjp.LISTENERS[:] = listeners
+
+
+def forget_polls(store):
+    mjp.POLLS.clear()
+    mjp.CHANNEL_POLLS.clear()
+    mjp.TIMELINES.clear()
+    mjp.LISTENERS.remove(store.record)
+
+
+def test_restore_from_snapshot_and_events(tmp_path, polls_state):
+    path = str(tmp_path / "polls.sqlite")
+    store = major_store.BallotStore(path, snapshot_every=4)
+    store.load()
+    poll = mjp.open_poll("Lunch", ["Pizza", "Sushi"], channel_id=1)
+    for user, grades in (("alice", (4, 2)), ("bob", (3, 3)), ("carol", (1, 0))):
+        poll.start(user)
+        for choice_index, grade_index in enumerate(grades):
+            poll.grade(user, choice_index, grade_index)
+    poll.validate("alice", at=10.0)
+    poll.reset("carol")
+    poll.start("dave")
+    poll.grade("dave", 0, 2)
+    expected = poll.snapshot()
+    # Written on shutdown, without any run() flush
+    store.close()
+
+    connection = sqlite3.connect(path)
+    snapshots = connection.execute("SELECT seq FROM snapshots").fetchall()
+    events = connection.execute("SELECT seq FROM events").fetchall()
+    connection.close()
+    assert len(snapshots) == 1
+    assert events and min(seq for seq, in events) > snapshots[0][0]
+
+    forget_polls(store)
+    store = major_store.BallotStore(path, snapshot_every=4)
+    store.load()
+    restored = mjp.get_channel_poll(1)
+    assert restored.snapshot() == expected
+    assert restored.results() == {"Pizza": [0, 0, 0, 1, 1], "Sushi": [0, 0, 1, 1, 0]}
+    assert restored.next_choice("dave") == 1
+    store.close()
+
+
+def test_closed_poll_not_restored(tmp_path, polls_state):
+    path = str(tmp_path / "polls.sqlite")
+    store = major_store.BallotStore(path)
+    store.load()
+    poll = mjp.open_poll("Lunch", ["Pizza"], channel_id=1)
+    poll.start("alice")
+    mjp.close_poll(poll)
+    store.close()
+
+    forget_polls(store)
+    store = major_store.BallotStore(path)
+    store.load()
+    assert mjp.POLLS == {}
+    store.close()
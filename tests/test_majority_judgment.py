@@ -0,0 +1,136 @@
+import math
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import majority_judgment as mj
+
+
+def test_aggregate_ballots_unsigned_grades():
+    ballots = np.array([[1, 5], [0, 2], [3, 9]], dtype=np.uint8)
+    results = mj.aggregate_ballots(ballots, [1, 2, 3, 4, 5], questions=["Q1", "Q2"])
+    assert results == {"Q1": [1, 0, 1, 0, 0], "Q2": [0, 1, 0, 0, 1]}
+
+
+def test_csv_watcher_truncated_to_header(tmp_path):
+    csv_file = tmp_path / "ballots.csv"
+    csv_file.write_text("Q1,Q2\n1,2\n3,3\n")
+    watcher = mj.CsvWatcher(str(csv_file), [1, 2, 3])
+    assert watcher.update()
+    assert watcher.results() == {"Q1": [1, 0, 1], "Q2": [0, 1, 1]}
+    assert not watcher.update()
+
+    csv_file.write_text("Q1,Q2\n")
+    assert watcher.update()
+    assert watcher.results() == {"Q1": [0, 0, 0], "Q2": [0, 0, 0]}
+    assert not watcher.update()
+
+
+def test_segments_ignore_columns(tmp_path):
+    csv = tmp_path / "export.csv"
+    csv.write_text("timestamp,team,region,Q1,Q2\n2024-03-01,a,n,1,5\n2024-03-02,b,s,3,4\n2024-03-03,a,s,5,5\n")
+    segments = mj.read_and_aggregate_segments(str(csv), [1, 2, 3, 4, 5], ["team"], ignore_first_column=True,
+                                              ignore_columns=["region"])
+    assert segments == {
+        ("a",): {"Q1": [1, 0, 0, 0, 1], "Q2": [0, 0, 0, 0, 2]},
+        ("b",): {"Q1": [0, 0, 1, 0, 0], "Q2": [0, 0, 0, 1, 0]},
+    }
+
+
+def test_render_disk_cache_skips_temporary_files(tmp_path):
+    mj.render_disk_cache_put(str(tmp_path), "key", (b"page",), "png")
+    (tmp_path / "key-0-1.png.123.tmp").write_bytes(b"pa")
+    assert mj.render_disk_cache_get(str(tmp_path), "key") == (b"page",)
+
+
+# Reference majority value: the medians (lower one of an even count) of the
+# grades, removing the median grade one vote at a time. Tallies of different
+# sizes are scaled to the same number of votes first.
+def majority_value(counts, total):
+    counts = [count * (total // sum(counts)) for count in counts]
+    values = []
+    for _ in range(total):
+        half = (sum(counts) + 1) // 2
+        cumulative = 0
+        for grade, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= half:
+                break
+        values.append(grade)
+        counts[grade] -= 1
+    return values
+
+
+def brute_force_ranking(results):
+    total = math.lcm(*[sum(counts) for counts in results.values()])
+    values = {question: majority_value(counts, total) for question, counts in results.items()}
+    order = sorted(results, key=lambda question: values[question], reverse=True)
+    ranking = []
+    for i, question in enumerate(order):
+        rank = ranking[-1][0] if i and values[question] == values[order[i - 1]] else i + 1
+        ranking.append((rank, question, values[question][0]))
+    return ranking
+
+
+def test_majority_ranking_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(500):
+        grades_count = rng.randint(2, 5)
+        results = {}
+        for i in range(rng.randint(2, 6)):
+            counts = [0] * grades_count
+            while not sum(counts):
+                counts = [rng.randint(0, 3) for _ in range(grades_count)]
+            results["Q%d" % i] = counts
+        assert sorted(mj.majority_ranking(results)) == sorted(brute_force_ranking(results))
+
+
+def test_majority_ranking_ties():
+    # Same median, broken by the share of votes above / below it
+    results = {"A": [0, 2, 1, 1, 0], "B": [1, 1, 1, 1, 0], "C": [1, 0, 2, 1, 0], "D": [0, 2, 1, 1, 0]}
+    assert mj.majority_ranking(results) == [(1, "C", 2), (2, "A", 1), (2, "D", 1), (4, "B", 1)]
+    keys = mj.majority_ranking_keys([results[question] for question in "ABCD"])
+    assert all(key[0] == key[3] for key in keys)
+
+
+def test_majority_ranking_unequal_totals():
+    # Same grade shares, different numbers of voters: ex aequo
+    results = {"A": [1, 2, 1], "B": [2, 4, 2], "C": [0, 3, 1], "D": [1, 1, 0]}
+    assert mj.majority_ranking(results) == [(1, "C", 1), (2, "A", 1), (2, "B", 1), (4, "D", 0)]
+
+
+def test_majority_ranking_empty_question():
+    results = {"A": [0, 0, 0], "B": [0, 1, 2], "C": [1, 0, 0]}
+    assert mj.majority_ranking(results) == [(1, "B", 2), (2, "A", 0), (2, "C", 0)]
+    assert mj.majority_ranking({}) == []
+
+
+def test_csv_watcher_last_row_without_newline():
+    file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "examples", "tier_list_lol.csv")
+    category_names = ["D", "C", "B", "A", "S"]
+    watcher = mj.CsvWatcher(file_path, category_names, values_type="str")
+    watcher.update()
+    # Counted once the size did not change between two updates
+    assert watcher.update() is True
+    assert watcher.update() is False
+    assert watcher.results() == mj.read_and_aggregate_csv(file_path, category_names, values_type="str")
+
+
+def test_csv_watcher_incomplete_last_row(tmp_path):
+    csv = tmp_path / "responses.csv"
+    csv.write_text("Q1,Q2\n1,2\n3")
+    watcher = mj.CsvWatcher(str(csv), [1, 2, 3, 4, 5])
+    assert watcher.update() is True
+    assert watcher.results() == {"Q1": [1, 0, 0, 0, 0], "Q2": [0, 1, 0, 0, 0]}
+    assert watcher.update() is True
+    assert watcher.results() == {"Q1": [1, 0, 1, 0, 0], "Q2": [0, 1, 1, 0, 0]}
+    # The last row was not finished, it is read again
+    with open(csv, "a") as file:
+        file.write(",4\n5,5\n")
+    assert watcher.update() is True
+    assert watcher.results() == {"Q1": [1, 0, 1, 0, 1], "Q2": [0, 1, 0, 1, 1]}
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tally-service"))
+import pytest
+import tally_service
+
+
+async def request(service, method, target, document=None):
+    body = json.dumps(document).encode("utf-8") if document is not None else b""
+    status, _, payload = await service.dispatch(method, target, body)
+    assert status == "200 OK"
+    return json.loads(payload)
+
+
+def test_create_submit_ranking():
+    async def main():
+        service = tally_service.TallyService()
+        poll = await request(service, "POST", "/polls", {
+            "title": "Lunch",
+            "questions": ["Pizza", "Sushi"],
+            "categories": ["Bad", "Okay", "Good"],
+        })
+        target = "/polls/" + poll["poll_id"]
+        accepted = await request(service, "POST", target + "/ballots", {"ballots": [
+            {"Pizza": "Good", "Sushi": "Okay"},
+            ["Okay", "Bad"],
+            {"Pizza": "Good"},
+            ["Great", "Good"],
+        ]})
+        assert accepted == {"accepted": 4}
+
+        summary = await request(service, "GET", target)
+        assert summary["voters"] == 4
+        assert summary["invalid"] == 1
+        assert summary["results"] == {"Pizza": [0, 1, 2], "Sushi": [1, 1, 1]}
+
+        ranking = await request(service, "GET", target + "/ranking")
+        assert [(record["rank"], record["question"], record["majority_grade"]) for record in ranking] == [
+            (1, "Pizza", "Good"), (2, "Sushi", "Okay")]
+
+    asyncio.run(main())
+
+
+def test_poll_questions_must_be_lists():
+    async def main():
+        service = tally_service.TallyService()
+        with pytest.raises(tally_service.HTTPError) as error:
+            await request(service, "POST", "/polls", {"questions": "abc", "categories": ["Bad", "Good"]})
+        assert error.value.status == "400 Bad Request"
+        assert service.polls == {}
+
+    asyncio.run(main())
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize("length", ["abc", "-1"])
+def test_invalid_content_length(length):
+    async def main():
+        service = tally_service.TallyService()
+        reader = asyncio.StreamReader()
+        reader.feed_data(("POST /polls HTTP/1.1\r\nContent-Length: %s\r\n\r\n{}" % length).encode("latin-1"))
+        reader.feed_eof()
+        writer = FakeWriter()
+        await service.handle_connection(reader, writer)
+        assert writer.data.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+        assert b"Connection: close" in writer.data
+        assert writer.closed
+
+    asyncio.run(main())